@@ -1,16 +1,153 @@
 from abc import ABC, abstractmethod
+import asyncio
 from collections import deque
-from settings import OPENAI_KEY
-from typing import Iterable, List, Optional, Tuple, TypeVar, Union
+from dataclasses import dataclass
+import logging
+import time
+from settings import (
+    CHATBOT_SECRETS,
+    COMPARE_MODELS,
+    COMPLETION_TOKENS_RESERVE,
+    CONTEXT_HISTORY_TOKENS,
+    CONTEXT_MAX_MESSAGES,
+    DEFAULT_CONTEXT_WINDOW,
+    LATENCY_WINDOW,
+    MESSAGE_TOKENS_OVERHEAD,
+    MODEL_CONTEXT_WINDOWS,
+    OPENAI_ATTEMPT_TIMEOUT,
+    OPENAI_BACKOFF_BASE,
+    OPENAI_BACKOFF_MAX,
+    OPENAI_HEDGE_MIN_SAMPLES,
+    OPENAI_HEDGE_PERCENTILE,
+    OPENAI_HEDGE_REQUESTS,
+    OPENAI_KEEPALIVE_TIMEOUT,
+    OPENAI_KEY_COOLDOWN,
+    OPENAI_KEY_RPM,
+    OPENAI_KEY_TPM,
+    OPENAI_KEYS_PATTERN,
+    OPENAI_MAX_ATTEMPTS,
+    OPENAI_POOL_SIZE,
+    OPENAI_POOL_WARM_CONNECTIONS,
+    OPENAI_REQUEST_DEADLINE,
+    RESPONSE_CACHE_DB,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_MAX_TEMPERATURE,
+    RESPONSE_CACHE_TTL,
+    ROUTER_ERROR_THRESHOLD,
+    ROUTER_LATENCY_LIMIT,
+    ROUTER_MAX_FALLBACKS,
+    ROUTER_MIN_REQUESTS,
+    ROUTER_MODELS,
+    ROUTER_OPEN_SECONDS,
+    ROUTER_SIMPLE_MAX_TOKENS,
+    ROUTER_WINDOW,
+    STREAM_RESPONSES,
+    SUMMARY_BATCH_TOKENS,
+    SUMMARY_MAX_PENDING_TOKENS,
+    SUMMARY_MAX_TOKENS,
+    SUMMARY_MODEL,
+    USAGE_DAILY_TOKEN_QUOTA,
+    USAGE_DB,
+    USAGE_USER_TOKEN_QUOTAS
+)
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union
+)
 
 import openai
-from openai.error import InvalidRequestError
+from openai.error import InvalidRequestError, OpenAIError, RateLimitError
+
+from http_session import SessionPool
+from key_pool import ApiKey, KeyPool
+from model_router import AUTO_MODEL, ModelRouter
+from resilience import (
+    DeadlineExceeded,
+    LatencyTracker,
+    RequestPolicy,
+    RetryNow,
+    retry_after
+)
+from response_cache import ResponseCache, request_fingerprint
+from single_flight import SingleFlight
+from tokenizer import count_tokens
+from usage import UsageMeter
+
+
+logger = logging.getLogger(__name__)
+
+key_pool = KeyPool.load(CHATBOT_SECRETS,
+                        OPENAI_KEYS_PATTERN,
+                        rpm=OPENAI_KEY_RPM,
+                        tpm=OPENAI_KEY_TPM,
+                        cooldown=OPENAI_KEY_COOLDOWN)
+# used by requests made outside of the pool, like warming up connections
+openai.api_key = key_pool.default.secret
+
+session_pool = SessionPool(pool_size=OPENAI_POOL_SIZE,
+                           keepalive_timeout=OPENAI_KEEPALIVE_TIMEOUT,
+                           warm_connections=OPENAI_POOL_WARM_CONNECTIONS)
+
+response_cache = ResponseCache(max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                               ttl=RESPONSE_CACHE_TTL,
+                               max_temperature=RESPONSE_CACHE_MAX_TEMPERATURE,
+                               disk_path=RESPONSE_CACHE_DB)
+
+in_flight = SingleFlight()
+
+latency = LatencyTracker(window=LATENCY_WINDOW)
+
+model_router = ModelRouter(models=ROUTER_MODELS,
+                           latency=latency,
+                           simple_max_tokens=ROUTER_SIMPLE_MAX_TOKENS,
+                           latency_limit=ROUTER_LATENCY_LIMIT,
+                           window=ROUTER_WINDOW,
+                           min_requests=ROUTER_MIN_REQUESTS,
+                           error_threshold=ROUTER_ERROR_THRESHOLD,
+                           open_seconds=ROUTER_OPEN_SECONDS)
+
+usage_meter = UsageMeter(USAGE_DB,
+                         daily_quota=USAGE_DAILY_TOKEN_QUOTA,
+                         user_quotas=USAGE_USER_TOKEN_QUOTAS)
+request_policy = RequestPolicy(deadline=OPENAI_REQUEST_DEADLINE,
+                               attempt_timeout=OPENAI_ATTEMPT_TIMEOUT,
+                               max_attempts=OPENAI_MAX_ATTEMPTS,
+                               backoff_base=OPENAI_BACKOFF_BASE,
+                               backoff_max=OPENAI_BACKOFF_MAX,
+                               latency=latency,
+                               hedge=OPENAI_HEDGE_REQUESTS,
+                               hedge_percentile=OPENAI_HEDGE_PERCENTILE,
+                               hedge_min_samples=OPENAI_HEDGE_MIN_SAMPLES)
 
+BackendImpl = TypeVar('BackendImpl', bound='AbstractBackend')
 
-api_key = OPENAI_KEY.read_text()
-openai.api_key = api_key
+SUMMARY_PROMPT = """Ниже краткое содержание разговора и реплики пользователя, \
+которые в него еще не вошли. Дополни краткое содержание этими репликами. \
+Сохрани все факты, имена, числа и договоренности, убери повторы. \
+Ответь только новым кратким содержанием.
 
-BackendImpl = TypeVar('BackendImpl', bound='AbstractBackend')
+Краткое содержание:
+{summary}
+
+Реплики:
+{turns}"""
+SUMMARY_HEADER = 'Краткое содержание предыдущего разговора:\n'
+UPSTREAM_FAILURE_MESSAGE = ('Модель не ответила вовремя, '
+                            'попробуй повторить запрос позже')
+EMPTY_ANSWER_MESSAGE = 'Модель вернула пустой ответ'
+MODEL_ERROR_MESSAGE = ('Модель сейчас недоступна, '
+                       'попробуй повторить запрос позже')
+STREAM_INTERRUPTED_MESSAGE = '[ответ прерван: модель перестала отвечать]'
+
+# tasks running off the request path, referenced here so that they are
+# not garbage collected before they finish
+_background_tasks = set()
 
 
 class AbstractBackend(ABC):
@@ -19,17 +156,37 @@ class AbstractBackend(ABC):
     async def handle(self, message: str) -> str:
         raise NotImplemented
 
+    async def handle_stream(self, message: str) -> AsyncIterator[str]:
+        yield await self.handle(message)
+
+    @property
+    def background_task(self) -> Optional[asyncio.Task]:
+        # work which still changes the backend after a request returned
+        return None
+
 
 class ChatGPTBackendError(Exception):
     pass
 
 
+class ModelRequestError(ChatGPTBackendError):
+    # the model gave no answer, the message is meant for the user
+    pass
+
+
+class ModelUnavailable(ModelRequestError):
+    # the model itself failed, another one may still answer
+    pass
+
+
 class ChatGPTBackend(AbstractBackend):
+    # class level default keeps contexts pickled before streaming loadable
+    _stream: bool = STREAM_RESPONSES
+    _history_cap: int = CONTEXT_HISTORY_TOKENS
 
     def __init__(self):
         self._context = deque([])
         self._model_name: str = 'gpt-3.5-turbo'
-        self._context_depth: int = 1
         self._max_tokens: Optional[int] = None
         self._temperature: Optional[float] = 1.0
         self._top_p: Optional[float] = 1.0
@@ -42,9 +199,77 @@ class ChatGPTBackend(AbstractBackend):
         return self._context
 
     def save_context(self, message: str):
-        while len(self._context) > self._context_depth:
-            self._context.popleft()
+        token_counts = self._token_counts()
         self._context.append(message)
+        token_counts.append(count_tokens(message, self._model_name))
+        # turns are kept while they fit the budget of the largest window
+        # the chat can be answered in, the oldest are the first to go.
+        # The newest turn stays even if it doesn't fit alone
+        budget = max(self._history_budget(model)
+                     for model in self._budget_models())
+        used = sum(tokens + MESSAGE_TOKENS_OVERHEAD for tokens in token_counts)
+        while len(self._context) > 1 and (
+                used > budget or len(self._context) > CONTEXT_MAX_MESSAGES):
+            used -= token_counts.popleft() + MESSAGE_TOKENS_OVERHEAD
+            self._on_evict(self._context.popleft())
+
+    def _on_evict(self, message: str):
+        pass
+
+    def _token_counts(self) -> deque:
+        # contexts pickled before token accounting have no counts yet
+        token_counts = getattr(self, '_context_tokens', None)
+        if token_counts is None or len(token_counts) != len(self._context):
+            token_counts = deque(count_tokens(msg, self._model_name)
+                                 for msg in self._context)
+            self._context_tokens = token_counts
+        return token_counts
+
+    def _pinned_context(self) -> List[str]:
+        return []
+
+    @property
+    def context_budget(self) -> int:
+        return self._context_budget(self._model_name)
+
+    def _context_budget(self, model: str) -> int:
+        window = MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+        return window - (self.max_tokens or COMPLETION_TOKENS_RESERVE)
+
+    def _budget_models(self) -> Iterable[str]:
+        if self._model_name == AUTO_MODEL:
+            return ROUTER_MODELS
+        return [self._model_name]
+
+    def _history_budget(self, model: str, reserved: int = 0) -> int:
+        # what is left for the stored turns after the pinned messages and
+        # `reserved` tokens, but no more than the chat's cap
+        available = self._context_budget(model) - reserved - sum(
+            count_tokens(msg, model) + MESSAGE_TOKENS_OVERHEAD
+            for msg in self._pinned_context()
+        )
+        return min(available, self._history_cap)
+
+    def _build_messages(self,
+                        message: str,
+                        model: Optional[str] = None) -> List[dict]:
+        model = model or self._model_name
+        pinned = self._pinned_context()
+        budget = self._history_budget(
+            model, count_tokens(message, model) + MESSAGE_TOKENS_OVERHEAD
+        )
+        # newest turns are kept, oldest are the first to go
+        history = []
+        for msg, tokens in zip(reversed(self._context),
+                               reversed(self._token_counts())):
+            cost = tokens + MESSAGE_TOKENS_OVERHEAD
+            if cost > budget:
+                break
+            budget -= cost
+            history.append(msg)
+        history.reverse()
+        return [{'role': self.role, 'content': msg}
+                for msg in [*pinned, *history, message]]
 
     def _parse_response(self, response: dict) -> Tuple[Union[str, None]]:
         choices = response.get('choices', None)
@@ -56,22 +281,250 @@ class ChatGPTBackend(AbstractBackend):
             return (role, content)
         return (None, None)
 
-    def ask(self, message: str) -> str:
-        messages = [{'role': self.role, 'content': msg} for msg in self.context]
-        messages.append({'role': self.role, 'content': message})
+    def _request_params(self, model: Optional[str] = None) -> dict:
+        return dict(model=model or self._model_name,
+                    max_tokens=self.max_tokens,
+                    temperature=self.temperature,
+                    top_p=self.top_p,
+                    frequency_penalty=self.frequency_penalty)
+
+    @staticmethod
+    def _prompt_tokens(messages: List[dict], model: Optional[str]) -> int:
+        return sum(count_tokens(msg['content'], model)
+                   + MESSAGE_TOKENS_OVERHEAD for msg in messages)
+
+    @classmethod
+    def _estimate_cost(cls, messages: List[dict], params: dict) -> int:
+        # tokens per minute limits count the requested completion size,
+        # not the tokens the answer ends up using
+        prompt = cls._prompt_tokens(messages, params.get('model'))
+        return prompt + (params.get('max_tokens') or COMPLETION_TOKENS_RESERVE)
+
+    def _completion(self,
+                    key: str,
+                    messages: List[dict],
+                    hedge: Optional[bool] = None,
+                    deadline: Optional[float] = None,
+                    **params) -> Awaitable:
+        # waiting for a key with rate limit headroom is done before an
+        # attempt is timed, so it isn't taken for a slow model. A stream
+        # comes with its lease, see `_open_stream`
+        cost = self._estimate_cost(messages, params)
+        create = (self._open_stream if params.get('stream')
+                  else self._create_completion)
+        return request_policy.call(
+            key,
+            lambda lease: create(lease, messages, **params),
+            hedge=hedge,
+            acquire=lambda: key_pool.acquire(cost),
+            deadline=deadline
+        )
+
+    async def _create_completion(self,
+                                 lease: Tuple[ApiKey, Tuple[float, int]],
+                                 messages: List[dict],
+                                 **params) -> dict:
+        if session_pool.started:
+            session_pool.bind()
+        key, spent = lease
+        start = time.monotonic()
+        try:
+            response = await openai.ChatCompletion.acreate(
+                messages=messages, api_key=key.secret, **params
+            )
+        except RateLimitError as exc:
+            key.settle(spent, 0)
+            key_pool.cool_down(key, retry_after(exc))
+            # a rate limited key is retried right away on another one,
+            # the caller backs off only when every key is cooling down
+            if key_pool.has_available():
+                raise RetryNow() from exc
+            raise
+        except BaseException:
+            # a failed or cancelled request doesn't hold its estimate in
+            # the tokens per minute budget
+            key.settle(spent, 0)
+            raise
+        # streamed responses carry no usage, they are metered and settled
+        # by the caller once the answer is read
+        if not params.get('stream'):
+            usage = response.get('usage') or {}
+            if usage.get('total_tokens'):
+                key.settle(spent, usage['total_tokens'])
+            usage_meter.record(params.get('model'),
+                               usage.get('prompt_tokens', 0),
+                               usage.get('completion_tokens', 0),
+                               time.monotonic() - start)
+        return response
+
+    async def _open_stream(self,
+                           lease: Tuple[ApiKey, Tuple[float, int]],
+                           messages: List[dict],
+                           **params) -> Tuple[AsyncIterator[dict],
+                                              Tuple[ApiKey, Tuple[float, int]]]:
+        # the lease keeps the estimate in the key's budget until the
+        # caller settles it with the tokens the answer took
+        return await self._create_completion(lease, messages, **params), lease
+
+    def _models_for(self, message: str) -> List[str]:
+        if self._model_name != AUTO_MODEL:
+            return [self._model_name]
+        return model_router.route(message)[:1 + ROUTER_MAX_FALLBACKS]
+
+    async def ask(self, message: str) -> str:
+        models = self._models_for(message)
+        # a fallback model only gets the time left, not a deadline of its own
+        deadline = request_policy.start_deadline()
+        for i, model in enumerate(models):
+            try:
+                content, _ = await self._ask_model(message, model, deadline)
+                return content
+            except ModelUnavailable:
+                if i + 1 == len(models):
+                    raise
+                model_router.fall_back(model, models[i + 1])
+
+    @staticmethod
+    def _model_failure(model: str, exc: Exception) -> ModelRequestError:
+        # a request the model rejected would be rejected by any other
+        # one, the rest of the errors are the model's and count against it
+        if (isinstance(exc, InvalidRequestError)
+                and exc.code != 'model_not_found'):
+            return ModelRequestError(str(exc))
+        model_router.record(model, ok=False)
+        logger.error('%s request failed: %r', model, exc)
+        if isinstance(exc, DeadlineExceeded):
+            return ModelUnavailable(UPSTREAM_FAILURE_MESSAGE)
+        # not retried: a revoked key, no access to the model and the
+        # like, the details are for the logs only
+        return ModelUnavailable(MODEL_ERROR_MESSAGE)
+
+    async def _ask_model(self,
+                         message: str,
+                         model: str,
+                         deadline: Optional[float] = None
+                         ) -> Tuple[str, Optional[dict]]:
+        # the answer and its usage, a cached answer has no usage
+        messages = self._build_messages(message, model)
+        params = self._request_params(model)
+        fingerprint = request_fingerprint(messages, params)
+        cache_key = None
+        if response_cache.cacheable(params):
+            cache_key = fingerprint
+            content = await response_cache.get(cache_key)
+            if content is not None:
+                return content, None
+        start = time.monotonic()
         try:
-            response = openai.ChatCompletion.create(
-                model=self._model_name,
-                messages=messages,
-                max_tokens=self.max_tokens,
-                temperature=self.temperature,
-                top_p=self.top_p,
-                frequency_penalty=self.frequency_penalty
+            response = await in_flight.run(
+                fingerprint,
+                lambda: self._completion(model,
+                                         messages,
+                                         deadline=deadline,
+                                         **params)
             )
             _, content = self._parse_response(response)
-        except InvalidRequestError as exc:
-            return str(exc)
-        return content
+        except (DeadlineExceeded, OpenAIError) as exc:
+            raise self._model_failure(model, exc) from exc
+        model_router.record(model, ok=True)
+        if not content:
+            raise ModelRequestError(EMPTY_ANSWER_MESSAGE)
+        if cache_key is not None and content:
+            await response_cache.put(cache_key,
+                                     content,
+                                     time.monotonic() - start)
+        return content, response.get('usage')
+
+    async def ask_stream(self, message: str) -> AsyncIterator[str]:
+        models = self._models_for(message)
+        # a fallback model only gets the time left, not a deadline of its own
+        start = time.monotonic()
+        deadline = request_policy.start_deadline()
+        for i, model in enumerate(models):
+            messages = self._build_messages(message, model)
+            params = self._request_params(model)
+            cache_key = None
+            if response_cache.cacheable(params):
+                cache_key = request_fingerprint(messages, params)
+                content = await response_cache.get(cache_key)
+                if content is not None:
+                    yield content
+                    return
+            try:
+                # only opening the stream is retried, once pieces have been
+                # shown a retry would repeat them
+                chunks, lease = await self._completion(f'{model}:stream',
+                                                       messages,
+                                                       hedge=False,
+                                                       deadline=deadline,
+                                                       stream=True,
+                                                       **params)
+            except (DeadlineExceeded, OpenAIError) as exc:
+                error = self._model_failure(model, exc)
+                if isinstance(error, ModelUnavailable) and i + 1 < len(models):
+                    model_router.fall_back(model, models[i + 1])
+                    continue
+                raise error from exc
+            break
+        # only the time spent waiting for the models counts towards the
+        # latency and the deadline, not the time the caller took to show
+        # the pieces
+        model_time = time.monotonic() - start
+        parts = []
+        try:
+            while True:
+                waited = time.monotonic()
+                try:
+                    chunk = await asyncio.wait_for(
+                        chunks.__anext__(),
+                        request_policy.deadline - model_time
+                    )
+                except StopAsyncIteration:
+                    break
+                finally:
+                    model_time += time.monotonic() - waited
+                choices = chunk.get('choices')
+                if not choices:
+                    continue
+                piece = choices[-1].get('delta', {}).get('content')
+                if piece:
+                    parts.append(piece)
+                    yield piece
+        except (asyncio.TimeoutError, OpenAIError) as exc:
+            model_router.record(model, ok=False)
+            logger.error('%s stream broke off after %d pieces: %r',
+                         model, len(parts), exc)
+            raise ModelRequestError(STREAM_INTERRUPTED_MESSAGE) from exc
+        finally:
+            # a caller which stops reading early leaves the stream open
+            await chunks.aclose()
+            # counted from the text, a stream doesn't report its usage.
+            # An answer cut short still cost its tokens
+            prompt_tokens = self._prompt_tokens(messages, model)
+            completion_tokens = count_tokens(''.join(parts), model)
+            key, spent = lease
+            key.settle(spent, prompt_tokens + completion_tokens)
+            usage_meter.record(model,
+                               prompt_tokens,
+                               completion_tokens,
+                               model_time)
+        model_router.record(model, ok=True)
+        if not parts:
+            raise ModelRequestError(EMPTY_ANSWER_MESSAGE)
+        if cache_key is not None:
+            await response_cache.put(cache_key, ''.join(parts), model_time)
+
+    async def handle_stream(self, message: str) -> AsyncIterator[str]:
+        async for piece in self.ask_stream(message):
+            yield piece
+
+    @property
+    def stream(self) -> bool:
+        return self._stream
+
+    @stream.setter
+    def stream(self, value: bool):
+        self._stream = value
 
     @property
     def model_name(self) -> str:
@@ -82,17 +535,17 @@ class ChatGPTBackend(AbstractBackend):
         self._model_name = value
     
     @property
-    def context_depth(self) -> int:
-        return self._context_depth
-    
-    @context_depth.setter
-    def context_depth(self, value: int):
-        if value < 1 or value > 30:
+    def context_tokens(self) -> int:
+        return self._history_cap
+
+    @context_tokens.setter
+    def context_tokens(self, value: int):
+        if value < 0:
             raise ChatGPTBackendError(
-                '`context_depth` parameter must be in range from 1 to 30'
+                '`context_tokens` parameter must not be negative'
             )
-        self._context_depth = value
-    
+        self._history_cap = value
+
     @property
     def max_tokens(self) -> Optional[int]:
         return self._max_tokens
@@ -167,10 +620,127 @@ class ChatGPTBackend(AbstractBackend):
 
 
 class FREEBackend(ChatGPTBackend):
+
+    # class level defaults keep contexts pickled before summaries loadable
+    _summarize: bool = False
+    _summary: Optional[str] = None
+    _evicted: Tuple[str] = ()
+    _fold_task: Optional[asyncio.Task] = None
+
+    @property
+    def summarize(self) -> bool:
+        return self._summarize
+
+    @summarize.setter
+    def summarize(self, value: bool):
+        self._summarize = value
+        if not value:
+            self._summary = None
+            self._evicted = ()
+
+    @property
+    def summary(self) -> Optional[str]:
+        return self._summary
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        # an unfinished summary task doesn't survive a restart, the turns
+        # it was folding are still in `_evicted`
+        state.pop('_fold_task', None)
+        return state
+
+    @property
+    def background_task(self) -> Optional[asyncio.Task]:
+        if self._fold_task is not None and not self._fold_task.done():
+            return self._fold_task
+        return None
+
+    def _pinned_context(self) -> List[str]:
+        if self._summarize and self._summary:
+            return [f'{SUMMARY_HEADER}{self._summary}']
+        return []
+
+    def _on_evict(self, message: str):
+        if not self._summarize:
+            return
+        self._evicted = (*self._evicted, message)
+        if self.background_task is None:
+            # a running fold takes turns off the front, they are trimmed
+            # only while there is none
+            self._trim_evicted()
+            task = asyncio.create_task(self._fold_summary())
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+            self._fold_task = task
+
+    def _trim_evicted(self):
+        # turns left after failed folds would grow the prompt past the
+        # window of the summary model, the oldest of them are dropped
+        tokens = [count_tokens(turn, SUMMARY_MODEL) for turn in self._evicted]
+        total = sum(tokens)
+        dropped = 0
+        while dropped < len(tokens) and total > SUMMARY_MAX_PENDING_TOKENS:
+            total -= tokens[dropped]
+            dropped += 1
+        if dropped:
+            logger.warning('Dropped %d turns which were not folded into '
+                           'the summary', dropped)
+            self._evicted = self._evicted[dropped:]
+
+    def _next_batch(self) -> Tuple[str]:
+        # the oldest turns which fit into one summary request
+        total = 0
+        for i, turn in enumerate(self._evicted):
+            total += count_tokens(turn, SUMMARY_MODEL)
+            if total > SUMMARY_BATCH_TOKENS:
+                return self._evicted[:i]
+        return self._evicted
+
+    async def _fold_summary(self):
+        try:
+            # turns evicted while a summary is being generated are folded
+            # in by the next iteration
+            while self._evicted:
+                evicted = self._next_batch()
+                if not evicted:
+                    logger.warning('Dropped a turn too long to be folded '
+                                   'into the summary')
+                    self._evicted = self._evicted[1:]
+                    continue
+                prompt = SUMMARY_PROMPT.format(summary=self._summary or '-',
+                                               turns='\n'.join(evicted))
+                # background summaries are kept out of the latencies the
+                # hedge delay and the router go by
+                response = await self._completion(
+                    f'{SUMMARY_MODEL}:summary',
+                    [{'role': 'user', 'content': prompt}],
+                    hedge=False,
+                    model=SUMMARY_MODEL,
+                    max_tokens=SUMMARY_MAX_TOKENS,
+                    temperature=0.0
+                )
+                _, content = self._parse_response(response)
+                if not self._summarize:
+                    return
+                if content:
+                    self._summary = content
+                self._evicted = self._evicted[len(evicted):]
+        except Exception:
+            logger.exception('Failed to fold %d turns into the summary',
+                             len(self._evicted))
+            self._trim_evicted()
+        finally:
+            self._fold_task = None
     
     async def handle(self, message: str) -> str:
+        answer = await self.ask(message)
+        self.save_context(message)
+        return answer
+
+    async def handle_stream(self, message: str) -> AsyncIterator[str]:
+        async for piece in self.ask_stream(message):
+            yield piece
         self.save_context(message)
-        return self.ask(message)
 
 
 class SQLBackend(ChatGPTBackend):
@@ -183,6 +753,9 @@ class SQLBackend(ChatGPTBackend):
     def context(self) -> Iterable[str]:
         return deque([self._sql_context, *super().context])
     
+    def _pinned_context(self) -> List[str]:
+        return [self._sql_context]
+
     @property
     def sql_prompt(self):
         return self._sql_context
@@ -192,7 +765,87 @@ class SQLBackend(ChatGPTBackend):
         self._sql_context = prompt
 
     async def handle(self, message: str) -> str:
-        return self.ask(message)
+        return await self.ask(message)
+
+
+@dataclass
+class ComparedAnswer:
+    model: str
+    answer: str
+    latency: float
+    prompt_tokens: int
+    completion_tokens: int
+    # `answer` holds the reason shown to the user
+    failed: bool = False
+
+
+class CompareBackend(SQLBackend):
+    # the same question goes to several models at once, answers come
+    # back in the order they arrive
+    _models: Tuple[str, ...] = COMPARE_MODELS
+
+    def __init__(self,
+                 sql_context: str,
+                 models: Iterable[str] = COMPARE_MODELS):
+        super().__init__(sql_context)
+        self.models = models
+
+    @property
+    def models(self) -> Tuple[str, ...]:
+        return self._models
+
+    @models.setter
+    def models(self, value: Iterable[str]):
+        models = tuple(value)
+        if not models or AUTO_MODEL in models:
+            raise ChatGPTBackendError('Models to compare must be set '
+                                      'explicitly')
+        self._models = models
+
+    async def _compare_one(self, message: str, model: str) -> ComparedAnswer:
+        start = time.monotonic()
+        failed = True
+        usage = None
+        try:
+            answer, usage = await self._ask_model(message, model)
+            failed = False
+        except ModelRequestError as exc:
+            answer = str(exc)
+        except Exception:
+            # a broken model doesn't take the answers of the others down
+            logger.exception('%s failed to answer a comparison', model)
+            answer = MODEL_ERROR_MESSAGE
+        latency = time.monotonic() - start
+        if usage:
+            prompt_tokens = usage.get('prompt_tokens', 0)
+            completion_tokens = usage.get('completion_tokens', 0)
+        else:
+            # cached answers and failures are estimated
+            prompt_tokens = self._prompt_tokens(
+                self._build_messages(message, model), model
+            )
+            completion_tokens = 0 if failed else count_tokens(answer, model)
+        return ComparedAnswer(model=model,
+                              answer=answer,
+                              latency=latency,
+                              prompt_tokens=prompt_tokens,
+                              completion_tokens=completion_tokens,
+                              failed=failed)
+
+    async def compare(self, message: str) -> AsyncIterator[ComparedAnswer]:
+        tasks = [asyncio.ensure_future(self._compare_one(message, model))
+                 for model in self._models]
+        try:
+            for next_answer in asyncio.as_completed(tasks):
+                yield await next_answer
+        finally:
+            # the reader stopped early, nobody waits for the rest
+            for task in tasks:
+                task.cancel()
+
+    async def handle(self, message: str) -> str:
+        return '\n\n'.join([f'[{compared.model}]\n{compared.answer}'
+                             async for compared in self.compare(message)])
 
 
 class DummyBackend(AbstractBackend):
@@ -0,0 +1,107 @@
+import argparse
+from pathlib import Path
+import random
+import re
+import tempfile
+import time
+
+from description import DescriptionParser
+from encoder import SimpleEncoder
+
+
+def legacy_encode(encoding_mapping: dict, data: str):
+    decoding_mapping = {}
+    words = data.split(' ')
+    pattern = re.compile('([\w\d._]+)')
+    for i, word in enumerate(words):
+        matches = pattern.findall(word)
+        if len(matches) == 0:
+            continue
+        for match in matches:
+            token = match.lower()
+            if not token in encoding_mapping.keys():
+                continue
+            token_encoded = encoding_mapping[token]
+            decoding_mapping[token_encoded] = decoding_mapping.get(
+                token_encoded, match
+            )
+            word = word.replace(match, token_encoded)
+        words[i] = word
+    return ' '.join(words), decoding_mapping
+
+
+def legacy_decode(data: str, decoding_mapping: dict):
+    words = data.split(' ')
+    pattern = re.compile('(unknown#[\d]+)')
+    for i, word in enumerate(words):
+        matches = pattern.findall(word)
+        if len(matches) == 0:
+            continue
+        tokens = [t for t in matches if t in decoding_mapping.keys()]
+        for token in tokens:
+            word = word.replace(token, decoding_mapping[token])
+        words[i] = word
+    return ' '.join(words)
+
+
+def generate_descriptions(directory: Path, tables: int, columns: int):
+    rnd = random.Random(0)
+    words = ['идентификатор', 'дата', 'сумма', 'регион', 'абонент',
+             'тариф', 'платеж', 'признак', 'код', 'наименование']
+    for t in range(tables):
+        lines = [f'Таблица dwh.fact_table_{t}']
+        for c in range(columns):
+            comment = ' '.join(rnd.choices(words, k=8))
+            lines.append(f'col_{t}_{c} ; {comment} (см. col_{t}_{rnd.randrange(columns)})')
+        (directory / f'table_{t}.txt').write_text('\n'.join(lines))
+
+
+def measure(func, *args, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(*args)
+    return (time.perf_counter() - start) / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tables', type=int, default=50)
+    parser.add_argument('--columns', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        generate_descriptions(Path(tmp_dir), args.tables, args.columns)
+        description_parser = DescriptionParser(tmp_dir)
+        encoder = SimpleEncoder(description_parser)
+        text = '\n'.join(description_parser.get_table_description(table)
+                         for table in sorted(description_parser.tables))
+
+    mapping = encoder._encoding_mapping
+    # the vocabulary is compiled on the first encode, time it on its own
+    compile_time, _ = measure(encoder.encode, '', repeat=1)
+    legacy_time, (legacy_encoded, legacy_mapping) = measure(
+        legacy_encode, mapping, text, repeat=args.repeat
+    )
+    new_time, (encoded, decoding_mapping) = measure(
+        encoder.encode, text, repeat=args.repeat
+    )
+    legacy_decode_time, _ = measure(legacy_decode, legacy_encoded,
+                                    legacy_mapping, repeat=args.repeat)
+    decode_time, decoded = measure(encoder.decode, encoded, decoding_mapping,
+                                   repeat=args.repeat)
+    assert decoded == text, 'round trip failed'
+
+    print(f'{args.tables} tables x {args.columns} columns, '
+          f'{len(text)} characters')
+    print(f'vocabulary compile: {compile_time * 1000:.1f} ms')
+    print(f'encode: legacy {legacy_time * 1000:.1f} ms, '
+          f'single pass {new_time * 1000:.1f} ms, '
+          f'x{legacy_time / new_time:.1f}')
+    print(f'decode: legacy {legacy_decode_time * 1000:.1f} ms, '
+          f'single pass {decode_time * 1000:.1f} ms, '
+          f'x{legacy_decode_time / decode_time:.1f}')
+
+
+if __name__ == '__main__':
+    main()
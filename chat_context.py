@@ -1,5 +1,6 @@
+import asyncio
 from dataclasses import dataclass
-from typing import Optional
+from typing import List, Optional, Tuple
 
 from backends import ChatGPTBackend
 
@@ -18,6 +19,19 @@ class BackendSwitcher:
         self._mode = default_mode
         self._model_name = default_model
 
+    @property
+    def modes(self) -> Tuple[str]:
+        return tuple(self._modes)
+
+    def add_mode(self, mode: str, backend: ChatGPTBackend):
+        if isinstance(backend, ChatGPTBackend):
+            backend.model_name = self._model_name
+        self._modes[mode] = backend
+
+    def background_tasks(self) -> List[asyncio.Task]:
+        return [backend.background_task for backend in self._modes.values()
+                if getattr(backend, 'background_task', None) is not None]
+
     @property
     def model_name(self) -> str:
         return self._model_name
@@ -0,0 +1,72 @@
+from dataclasses import dataclass
+import re
+from typing import List, Set, Tuple
+
+from encoder import EncodedColumn, EncodedTable
+from table_retriever import tokenize
+from tokenizer import count_tokens
+
+
+_KEY_PATTERN = re.compile(r'(^id$|^id_|_id$|_key$|^key_|_sk$)')
+# whole words only: "подключения" or "keyboard" don't make a column a key
+_KEY_COMMENT_PATTERN = re.compile(r'\bключ|\bkey\b', re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class PrunedTable:
+    text: str
+    kept: int
+    total: int
+    tokens_full: int
+    tokens_kept: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_full - self.tokens_kept
+
+
+class ColumnPruner:
+
+    def __init__(self, token_budget: int):
+        self._token_budget = token_budget
+
+    @staticmethod
+    def is_key(column: EncodedColumn) -> bool:
+        return bool(_KEY_PATTERN.search(column.name)
+                    or _KEY_COMMENT_PATTERN.search(column.text))
+
+    @staticmethod
+    def _score(column: EncodedColumn, question_terms: Set[str]) -> float:
+        name_terms = set(tokenize(column.name))
+        text_terms = set(tokenize(column.text))
+        # a hit in the column name is worth more than one in the comment
+        return (2 * len(name_terms & question_terms)
+                + len(text_terms & question_terms))
+
+    def prune(self, table: EncodedTable, question: str) -> PrunedTable:
+        tokens_full = table.tokens
+        if tokens_full <= self._token_budget:
+            return PrunedTable(table.render(), len(table.columns),
+                               len(table.columns), tokens_full, tokens_full)
+        question_terms = set(tokenize(question))
+        budget = self._token_budget - count_tokens(table.header)
+        keep: List[int] = []
+        ranked: List[Tuple[float, int]] = []
+        for i, column in enumerate(table.columns):
+            if self.is_key(column):
+                keep.append(i)
+                budget -= column.tokens
+            else:
+                ranked.append((-self._score(column, question_terms), i))
+        # stable on ties, so equally relevant columns keep table order and
+        # the rest of the budget is filled with the first unmatched ones
+        for _, i in sorted(ranked):
+            if table.columns[i].tokens > budget:
+                continue
+            keep.append(i)
+            budget -= table.columns[i].tokens
+        columns = [table.columns[i] for i in sorted(keep)]
+        tokens_kept = (count_tokens(table.header)
+                       + sum(column.tokens for column in columns))
+        return PrunedTable(table.render(columns), len(columns),
+                           len(table.columns), tokens_full, tokens_kept)
@@ -0,0 +1,261 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from pathlib import Path
+import pickle
+import sqlite3
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from chat_context import ChatContext
+
+
+logger = logging.getLogger(__name__)
+
+
+class ChatContextStore:
+
+    def __init__(self,
+                 db_path: str,
+                 legacy_dump_path: Optional[str] = None,
+                 cache_size: int = 1000,
+                 idle_timeout: float = 1800.0):
+        self._db_path = str(db_path)
+        self._cache_size = cache_size
+        self._idle_timeout = idle_timeout
+        # sqlite connection is owned by a single worker thread, so every
+        # database call goes through this executor
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='context-store')
+        self._connection: Optional[sqlite3.Connection] = None
+        self._cache: OrderedDict[int, ChatContext] = OrderedDict()
+        self._last_used: Dict[int, float] = {}
+        self._pins: Dict[int, int] = {}
+        self._loading: Dict[int, asyncio.Future] = {}
+        self._dirty: Set[int] = set()
+        # contexts evicted before their dirty state was written
+        self._pending: Dict[int, bytes] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._executor.submit(self._open).result()
+        if legacy_dump_path is not None:
+            self._executor.submit(self._migrate_from_pickle,
+                                  Path(legacy_dump_path)).result()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'cached': len(self._cache),
+            'hits': self._hits,
+            'misses': self._misses,
+            'evictions': self._evictions,
+            'dirty': len(self._dirty) + len(self._pending)
+        }
+
+    def _open(self):
+        self._connection = sqlite3.connect(self._db_path)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS chat_contexts ('
+            'chat_id INTEGER PRIMARY KEY, '
+            'data BLOB NOT NULL)'
+        )
+        self._connection.commit()
+
+    def _migrate_from_pickle(self, dump_path: Path):
+        if not dump_path.exists():
+            return
+        count, = self._connection.execute(
+            'SELECT COUNT(*) FROM chat_contexts'
+        ).fetchone()
+        if count:
+            return
+        with open(dump_path, 'rb') as f:
+            try:
+                contexts = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError):
+                contexts = {}
+        self._write_rows([(chat_id, pickle.dumps(context))
+                          for chat_id, context in contexts.items()])
+        dump_path.rename(dump_path.with_suffix('.pickle.migrated'))
+        logger.info('Migrated %d chat contexts from %s',
+                    len(contexts), dump_path)
+
+    def _write_rows(self, rows: List[Tuple[int, bytes]]):
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO chat_contexts (chat_id, data) '
+                'VALUES (?, ?)',
+                rows
+            )
+
+    def _read_row(self, chat_id: int) -> Optional[bytes]:
+        row = self._connection.execute(
+            'SELECT data FROM chat_contexts WHERE chat_id = ?', (chat_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def acquire(self, chat_id: int) -> Optional[ChatContext]:
+        # pinned contexts are never evicted, so a handler can't keep
+        # mutating an object which was already written back and dropped
+        self._pins[chat_id] = self._pins.get(chat_id, 0) + 1
+        try:
+            return await self._get(chat_id)
+        except BaseException:
+            self.release(chat_id)
+            raise
+
+    def hold(self, chat_id: int, task: asyncio.Future):
+        # background work of a handler, like folding a summary, changes
+        # the context after the handler returned, so the context stays
+        # pinned until it is done and is written once more afterwards
+        self._pins[chat_id] = self._pins.get(chat_id, 0) + 1
+
+        def done(_: asyncio.Future):
+            self.mark_dirty(chat_id)
+            self.release(chat_id)
+            self.schedule_flush()
+
+        task.add_done_callback(done)
+
+    def release(self, chat_id: int):
+        pins = self._pins.get(chat_id, 0) - 1
+        if pins > 0:
+            self._pins[chat_id] = pins
+        else:
+            self._pins.pop(chat_id, None)
+            self._evict_overflow()
+
+    async def _get(self, chat_id: int) -> Optional[ChatContext]:
+        if chat_id in self._cache:
+            self._hits += 1
+            self._touch(chat_id)
+            return self._cache[chat_id]
+        if chat_id in self._loading:
+            return await asyncio.shield(self._loading[chat_id])
+        self._misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._loading[chat_id] = future
+        try:
+            data = self._pending.get(chat_id)
+            if data is None:
+                data = await self._run(self._read_row, chat_id)
+            context = self._unpickle(chat_id, data)
+            if context is not None:
+                self._insert(chat_id, context)
+            future.set_result(context)
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            del self._loading[chat_id]
+        return context
+
+    @staticmethod
+    def _unpickle(chat_id: int, data: Optional[bytes]) -> Optional[ChatContext]:
+        if data is None:
+            return None
+        try:
+            return pickle.loads(data)
+        except (EOFError, pickle.UnpicklingError, AttributeError) as exc:
+            logger.warning('Dropping broken context of chat %s: %s',
+                           chat_id, exc)
+            return None
+
+    def put(self, chat_id: int, context: ChatContext):
+        # marked first, a context evicted right away is kept as pending
+        self.mark_dirty(chat_id)
+        self._insert(chat_id, context)
+
+    def _insert(self, chat_id: int, context: ChatContext):
+        self._cache[chat_id] = context
+        self._touch(chat_id)
+        self._evict_overflow()
+
+    def _touch(self, chat_id: int):
+        self._cache.move_to_end(chat_id)
+        self._last_used[chat_id] = time.monotonic()
+
+    def _evict_overflow(self):
+        if len(self._cache) <= self._cache_size:
+            return
+        for chat_id in list(self._cache):
+            if len(self._cache) <= self._cache_size:
+                break
+            if chat_id not in self._pins:
+                self._evict(chat_id)
+
+    def _evict(self, chat_id: int):
+        context = self._cache.pop(chat_id)
+        self._last_used.pop(chat_id, None)
+        if chat_id in self._dirty:
+            self._dirty.discard(chat_id)
+            self._pending[chat_id] = pickle.dumps(context)
+        self._evictions += 1
+
+    def evict_idle(self) -> int:
+        deadline = time.monotonic() - self._idle_timeout
+        idle = [chat_id for chat_id, used in self._last_used.items()
+                if used < deadline and chat_id not in self._pins]
+        for chat_id in idle:
+            self._evict(chat_id)
+        if self._pending:
+            self.schedule_flush()
+        return len(idle)
+
+    async def sweep_forever(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            evicted = self.evict_idle()
+            if evicted:
+                logger.info('Evicted %d idle chat contexts, stats: %s',
+                            evicted, self.stats)
+
+    def mark_dirty(self, chat_id: int):
+        self._dirty.add(chat_id)
+
+    def schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        # chats marked dirty while a batch is being written are picked up
+        # by the next iteration instead of spawning another task
+        while self._dirty or self._pending:
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Failed to flush chat contexts')
+                return
+
+    async def flush(self):
+        # pickling happens on the event loop so that a context is never
+        # serialized while a handler is halfway through mutating it
+        rows = dict(self._pending)
+        rows.update((chat_id, pickle.dumps(self._cache[chat_id]))
+                    for chat_id in self._dirty if chat_id in self._cache)
+        self._pending.clear()
+        self._dirty.clear()
+        if not rows:
+            return
+        try:
+            await self._run(self._write_rows, list(rows.items()))
+        except Exception:
+            for chat_id, data in rows.items():
+                self._pending.setdefault(chat_id, data)
+            raise
+
+    async def close(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        await self.flush()
+        await self._run(self._connection.close)
+        self._executor.shutdown(wait=True)
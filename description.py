@@ -1,6 +1,10 @@
+import copy
+import hashlib
 from pathlib import Path
 import re
-from typing import List, Set, Tuple
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from schema_snapshot import SchemaSnapshot, SnapshotDescriptions
 
 
 class DescriptionParserError(Exception):
@@ -9,32 +13,160 @@ class DescriptionParserError(Exception):
 
 class DescriptionParser:
 
-    def __init__(self, description_dir: str):
+    def __init__(self,
+                 description_dir: str,
+                 snapshot_path: Optional[str] = None):
         self._table_pattern = re.compile('Таблица ([\w.\d]+)$')
         self._column_pattern = re.compile('^([\w\d]+)[\s]*;')
         self._description_dir = Path(description_dir)
+        self._snapshot_path = Path(snapshot_path) if snapshot_path else None
+        self._snapshot: Optional[SchemaSnapshot] = None
         self._tables = dict()
         self._descriptions = dict()
+        self._files = dict()
+        self._version = 0
+        self._digest: Optional[str] = None
         self.reload_description()
 
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def digest(self) -> str:
+        # hash of the descriptions, unlike `version` it is the same after
+        # a restart as long as they didn't change
+        if self._snapshot is not None:
+            return self._snapshot.digest
+        if self._digest is None:
+            digest = hashlib.sha256()
+            for table in sorted(self._descriptions):
+                data = self._descriptions[table].encode('utf-8')
+                digest.update(f'{table}\0{hashlib.sha256(data).hexdigest()}\0'
+                              .encode('utf-8'))
+            self._digest = digest.hexdigest()
+        return self._digest
+
+    @property
+    def description_dir(self) -> Path:
+        return self._description_dir
+
+    @property
+    def files(self) -> Dict[str, str]:
+        return dict(self._files)
+
     @property
     def tables(self) -> Set[str]:
         return set(map(str.lower, self._tables.keys()))
+
+    @property
+    def tokens(self) -> Tuple[str]:
+        if self._snapshot is not None:
+            return self._snapshot.tokens
+        tokens = set(self._tables)
+        for columns in self._tables.values():
+            tokens.update(columns)
+        return tuple(sorted(tokens))
     
     def get_table_description(self, table: str) -> str:
         return self._descriptions[table.lower()]
     
     def get_table_columns(self, table: str) -> Tuple[str]:
         return self._tables[table.lower()]
+
+    def split_table_description(
+        self,
+        table: str
+    ) -> Tuple[str, List[Tuple[str, str]]]:
+        # header lines and (column, text) pairs; lines which are not column
+        # definitions belong to the column above them
+        header, columns = [], []
+        for line in self.get_table_description(table).strip().split('\n'):
+            match = self._column_pattern.search(line)
+            if match:
+                columns.append((match[1].lower(), [line]))
+            elif columns:
+                columns[-1][1].append(line)
+            else:
+                header.append(line)
+        return ('\n'.join(header),
+                [(column, '\n'.join(lines)) for column, lines in columns])
     
     def reload_description(self):
         if not self._description_dir.exists():
             raise DescriptionParserError('Couldn\'t find description dir: '
                                          f'{self._description_dir}')
-        for filename in self._description_dir.glob('*.txt'):
+        if self._snapshot_path is not None:
+            errors = self._load_snapshot(self._snapshot)
+            if errors:
+                raise ValueError('; '.join(f'{filename}: {error}'
+                                           for filename, error in errors.items()))
+            self._version += 1
+            return
+        tables, descriptions, files = {}, {}, {}
+        for filename in sorted(self._description_dir.glob('*.txt')):
             table, columns, desc = self._parse_file(filename)
-            self._tables[table] = columns
-            self._descriptions[table] = desc
+            tables[table] = columns
+            descriptions[table] = desc
+            files[str(filename)] = table
+        self._tables = tables
+        self._descriptions = descriptions
+        self._files = files
+        self._digest = None
+        self._version += 1
+
+    def apply_changes(
+        self,
+        changed: Iterable[str],
+        removed: Iterable[str]
+    ) -> Tuple['DescriptionParser', Dict[str, str]]:
+        # copy-on-write, so readers holding the old parser keep a
+        # consistent view while the new one is being built
+        parser = copy.copy(self)
+        parser._version = self._version + 1
+        parser._digest = None
+        if self._snapshot_path is not None:
+            # unchanged descriptions are copied between the mappings as
+            # bytes, only changed files are parsed
+            return parser, parser._load_snapshot(self._snapshot)
+        parser._tables = dict(self._tables)
+        parser._descriptions = dict(self._descriptions)
+        parser._files = dict(self._files)
+        errors = {}
+        for filename in removed:
+            parser._drop_file(str(filename))
+        for filename in changed:
+            try:
+                table, columns, desc = self._parse_file(filename)
+            except (OSError, ValueError) as exc:
+                errors[str(filename)] = str(exc)
+                continue
+            parser._drop_file(str(filename))
+            parser._tables[table] = columns
+            parser._descriptions[table] = desc
+            parser._files[str(filename)] = table
+        return parser, errors
+
+    def _load_snapshot(self,
+                       previous: Optional[SchemaSnapshot]) -> Dict[str, str]:
+        snapshot, errors = SchemaSnapshot.compile(self._description_dir,
+                                                  self._snapshot_path,
+                                                  self._parse_file,
+                                                  previous)
+        self._snapshot = snapshot
+        self._tables = {table: columns for table, (_, _, columns, _)
+                        in snapshot.tables.items()}
+        self._descriptions = SnapshotDescriptions(snapshot)
+        self._files = {str(self._description_dir / filename): table
+                       for table, (*_, filename) in snapshot.tables.items()}
+        return {str(self._description_dir / filename): error
+                for filename, error in errors.items()}
+
+    def _drop_file(self, filename: str):
+        table = self._files.pop(filename, None)
+        if table is not None and table not in self._files.values():
+            self._tables.pop(table, None)
+            self._descriptions.pop(table, None)
 
     def _parse_file(self, filename: str) -> Tuple[str, List[str], str]:
         with open(filename, 'r') as f:
@@ -0,0 +1,158 @@
+import asyncio
+from dataclasses import dataclass, field
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from description import DescriptionParser
+from encoder import SimpleEncoder
+from table_retriever import TableRetriever
+
+
+logger = logging.getLogger(__name__)
+
+FileState = Tuple[int, int]
+
+
+@dataclass(frozen=True)
+class Schema:
+    description_parser: DescriptionParser
+    encoder: SimpleEncoder
+    retriever: TableRetriever
+    # the retriever index is kept there between runs
+    index_path: Optional[Path] = None
+
+    @classmethod
+    def build(cls,
+              description_parser: DescriptionParser,
+              index_path: Optional[Path] = None,
+              encoder_cache_size: int = 200) -> 'Schema':
+        retriever = None
+        if index_path is not None and index_path.exists():
+            retriever = TableRetriever.load(index_path,
+                                            description_parser.digest)
+        if retriever is None:
+            retriever = TableRetriever(description_parser)
+            cls._save_index(retriever, description_parser, index_path)
+        return cls(description_parser,
+                   SimpleEncoder(description_parser, encoder_cache_size),
+                   retriever,
+                   index_path)
+
+    def updated(self,
+                description_parser: DescriptionParser,
+                tables: Iterable[str]) -> 'Schema':
+        # only what the changed tables affect is rebuilt
+        tables = list(tables)
+        encoder = self.encoder.updated(description_parser, tables)
+        retriever = self.retriever.updated(description_parser, tables)
+        self._save_index(retriever, description_parser, self.index_path)
+        return Schema(description_parser, encoder, retriever, self.index_path)
+
+    @staticmethod
+    def _save_index(retriever: TableRetriever,
+                    description_parser: DescriptionParser,
+                    index_path: Optional[Path]):
+        if index_path is None:
+            return
+        try:
+            retriever.save(index_path, description_parser.digest)
+        except OSError as exc:
+            # the index is built again on the next start
+            logger.warning('Failed to save retrieval index %s: %s',
+                           index_path, exc)
+
+
+@dataclass
+class SchemaChanges:
+    added: List[str] = field(default_factory=list)
+    changed: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    errors: Dict[str, str] = field(default_factory=dict)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.changed or self.removed or self.errors)
+
+    def __str__(self) -> str:
+        if not self:
+            return 'Изменений нет'
+        lines = []
+        for title, tables in (('Добавлены', self.added),
+                              ('Изменены', self.changed),
+                              ('Удалены', self.removed)):
+            if tables:
+                lines.append(f'{title}: {", ".join(sorted(tables))}')
+        for filename, error in self.errors.items():
+            lines.append(f'Ошибка в {os.path.basename(filename)}: {error}')
+        return '\n'.join(lines)
+
+
+class DescriptionWatcher:
+
+    def __init__(self, schema: Schema, interval: float = 10.0):
+        self._schema = schema
+        self._interval = interval
+        self._lock = asyncio.Lock()
+        self._states = self._scan()
+
+    @property
+    def schema(self) -> Schema:
+        # handlers read this once per request and keep the snapshot
+        return self._schema
+
+    def _scan(self) -> Dict[str, FileState]:
+        states = {}
+        directory = self._schema.description_parser.description_dir
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.txt') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                states[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return states
+
+    async def reload(self) -> SchemaChanges:
+        async with self._lock:
+            states = await asyncio.to_thread(self._scan)
+            changed = [path for path, state in states.items()
+                       if self._states.get(path) != state]
+            removed = [path for path in self._states if path not in states]
+            if not changed and not removed:
+                return SchemaChanges()
+            schema, changes = await asyncio.to_thread(self._build,
+                                                      changed,
+                                                      removed)
+            # broken files are parsed again only after they change again
+            self._states = states
+            self._schema = schema
+        logger.info('Reloaded table descriptions: %s',
+                    str(changes).replace('\n', '; '))
+        return changes
+
+    def _build(self,
+               changed: List[str],
+               removed: List[str]) -> Tuple[Schema, SchemaChanges]:
+        old_parser = self._schema.description_parser
+        parser, errors = old_parser.apply_changes(changed, removed)
+        old_tables, new_tables = old_parser.tables, parser.tables
+        new_files = parser.files
+        changes = SchemaChanges(
+            added=sorted(new_tables - old_tables),
+            changed=sorted({new_files[path] for path in changed
+                            if path in new_files} & old_tables),
+            removed=sorted(old_tables - new_tables),
+            errors=errors
+        )
+        schema = self._schema.updated(
+            parser, [*changes.added, *changes.changed, *changes.removed]
+        )
+        return schema, changes
+
+    async def watch_forever(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self.reload()
+            except Exception:
+                logger.exception('Failed to reload table descriptions')
@@ -1,22 +1,114 @@
+from collections import OrderedDict
+import copy
+from dataclasses import dataclass
 import re
-from typing import Dict, Iterable, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from description import DescriptionParser
+from tokenizer import count_tokens
+
+
+_ENCODED_TOKEN_PATTERN = re.compile(r'unknown#\d+')
+
+
+def _trie_regex(tokens: Iterable[str]) -> str:
+    trie = {}
+    for token in tokens:
+        node = trie
+        for char in token:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node: dict) -> str:
+        end = '' in node
+        branches = [re.escape(char) + build(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        if len(branches) == 1 and not end:
+            return branches[0]
+        group = '(?:' + '|'.join(branches) + ')'
+        return group + '?' if end else group
+
+    return build(trie)
+
+
+def _compile_vocabulary(tokens: Iterable[str]) -> re.Pattern:
+    tokens = list(tokens)
+    if not tokens:
+        return re.compile(r'(?!x)x')
+    # a token must be a whole name: not a part of a longer word or of
+    # a dotted name, but trailing punctuation dots are fine
+    return re.compile(r'(?<![\w.])' + _trie_regex(tokens) + r'(?![\w]|\.\w)',
+                      re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class EncodedColumn:
+    name: str
+    text: str
+    encoded: str
+    tokens: int
+
+
+@dataclass(frozen=True)
+class EncodedTable:
+    header: str
+    columns: Tuple[EncodedColumn]
+    # shared between requests, don't mutate
+    decoding_mapping: Dict[str, str]
+
+    @property
+    def tokens(self) -> int:
+        return count_tokens(self.header) + sum(c.tokens for c in self.columns)
+
+    def render(self, columns: Optional[Iterable[EncodedColumn]] = None) -> str:
+        columns = self.columns if columns is None else columns
+        return '\n'.join([self.header, *(c.encoded for c in columns)])
 
 
 class SimpleEncoder:
 
-    def __init__(self, description_parser: DescriptionParser):
+    def __init__(self,
+                 description_parser: DescriptionParser,
+                 cache_size: int = 200):
         self._encoding_mapping = {}
         self._decoding_mapping = {}
         self._description_parser = description_parser
+        # least recently used tables are dropped first
+        self._cache_size = cache_size
+        self._encoded_tables: OrderedDict[str, EncodedTable] = OrderedDict()
+        self._schema_version: Optional[int] = None
+        self._tokens: Tuple[str] = ()
+        # compiled on the first encode, so starting from a snapshot
+        # doesn't pay for the whole vocabulary. A list, so encoders made
+        # by updated() share whichever of them compiles it first
+        self._pattern: List[Optional[re.Pattern]] = [None]
         self.reload_mapping()
     
     def reload_mapping(self):
-        tokens = set(self._description_parser.tables)
-        for table in self._description_parser.tables:
-            tokens |= set(self._description_parser.get_table_columns(table))
-        self._encoding_mapping = self._create_encoding_mapping(tokens)
+        self._encoded_tables = OrderedDict()
+        self._schema_version = self._description_parser.version
+        # tokens come sorted, so unknown#N ids are stable between runs
+        self._tokens = self._description_parser.tokens
+        self._encoding_mapping = self._create_encoding_mapping(self._tokens)
+        self._pattern = [None]
+
+    def updated(self,
+                description_parser: DescriptionParser,
+                tables: Iterable[str]) -> 'SimpleEncoder':
+        # an encoder for a parser with some tables changed. While the set
+        # of names stays the same the compiled vocabulary is shared and
+        # only the changed tables are encoded again
+        if description_parser.tokens != self._tokens:
+            return SimpleEncoder(description_parser, self._cache_size)
+        encoder = copy.copy(self)
+        encoder._description_parser = description_parser
+        encoder._schema_version = description_parser.version
+        encoder._encoded_tables = OrderedDict(self._encoded_tables)
+        for table in tables:
+            encoder._encoded_tables.pop(table.lower(), None)
+        return encoder
     
     def gen_key(self, counter=0):
         while 1:
@@ -29,36 +121,86 @@ class SimpleEncoder:
             mapping[token] = key
         return mapping
 
+    def _vocabulary(self) -> re.Pattern:
+        if self._pattern[0] is None:
+            self._pattern[0] = _compile_vocabulary(self._encoding_mapping)
+        return self._pattern[0]
+
     def encode(self, data: str) -> Tuple[str, dict[str, str]]:
         decoding_mapping = {}
-        words = data.split(' ')
-        pattern = re.compile('([\w\d._]+)')
-        for i, word in enumerate(words):
-            matches = pattern.findall(word)
-            if len(matches) == 0:
-                continue
-            for match in matches:
-                token = match.lower()
-                if not token in self._encoding_mapping.keys():
-                    continue
-                token_encoded = self._encoding_mapping[token]
-                decoding_mapping[token_encoded] = decoding_mapping.get(
-                    token_encoded, match
-                )
-                word = word.replace(match, token_encoded)
-            words[i] = word
-        return ' '.join(words), decoding_mapping
+        encoding_mapping = self._encoding_mapping
+
+        def replace(match: re.Match) -> str:
+            token = match[0]
+            # case-insensitive matching also takes characters like "ſ"
+            # whose lower case isn't in the vocabulary
+            token_encoded = encoding_mapping.get(token.lower())
+            if token_encoded is None:
+                return token
+            decoding_mapping.setdefault(token_encoded, token)
+            return token_encoded
+
+        return self._vocabulary().sub(replace, data), decoding_mapping
+
+    def encode_table(self, table: str) -> EncodedTable:
+        if self._schema_version != self._description_parser.version:
+            self.reload_mapping()
+        table = table.lower()
+        encoded_table = self._encoded_tables.get(table)
+        if encoded_table is None:
+            encoded_table = self._encode_table(table)
+            self._encoded_tables[table] = encoded_table
+            if len(self._encoded_tables) > self._cache_size:
+                self._encoded_tables.popitem(last=False)
+        else:
+            self._encoded_tables.move_to_end(table)
+        return encoded_table
+
+    def _encode_table(self, table: str) -> EncodedTable:
+        header, columns = self._description_parser.split_table_description(
+            table
+        )
+        decoding_mapping = {}
+        encoded_header, mapping = self.encode(header)
+        decoding_mapping.update(mapping)
+        encoded_columns = []
+        for name, text in columns:
+            encoded, mapping = self.encode(text)
+            for key, value in mapping.items():
+                decoding_mapping.setdefault(key, value)
+            encoded_columns.append(
+                EncodedColumn(name, text, encoded, count_tokens(encoded))
+            )
+        return EncodedTable(encoded_header,
+                            tuple(encoded_columns),
+                            decoding_mapping)
 
     @staticmethod
     def decode(data: str, decoding_mapping: dict[str, str]) -> str:
-        words = data.split(' ')
-        pattern = re.compile('(unknown#[\d]+)')
-        for i, word in enumerate(words):
-            matches = pattern.findall(word)
-            if len(matches) == 0:
-                continue
-            tokens = [t for t in matches if t in decoding_mapping.keys()]
-            for token in tokens:
-                word = word.replace(token, decoding_mapping[token])
-            words[i] = word
-        return ' '.join(words)
+        return _ENCODED_TOKEN_PATTERN.sub(
+            lambda match: decoding_mapping.get(match[0], match[0]), data
+        )
+
+
+class StreamDecoder:
+    # an encoded token may be split between two chunks of a streamed
+    # answer, a tail which can still grow into one is held back until
+    # the next chunk shows how it ends
+    _PARTIAL_TOKEN = re.compile(
+        r'u(?:n(?:k(?:n(?:o(?:w(?:n(?:#\d*)?)?)?)?)?)?)?$'
+    )
+
+    def __init__(self, decoding_mapping: Dict[str, str]):
+        self._decoding_mapping = decoding_mapping
+        self._pending = ''
+
+    def feed(self, chunk: str) -> str:
+        data = self._pending + chunk
+        match = self._PARTIAL_TOKEN.search(data)
+        cut = match.start() if match else len(data)
+        self._pending = data[cut:]
+        return SimpleEncoder.decode(data[:cut], self._decoding_mapping)
+
+    def flush(self) -> str:
+        data, self._pending = self._pending, ''
+        return SimpleEncoder.decode(data, self._decoding_mapping)
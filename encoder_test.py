@@ -0,0 +1,47 @@
+from pathlib import Path
+
+import pytest
+
+from description import DescriptionParser
+from encoder import SimpleEncoder, StreamDecoder
+
+
+@pytest.fixture
+def encoder(tmp_path: Path) -> SimpleEncoder:
+    (tmp_path / 'subscribers.txt').write_text(
+        'Таблица dwh.subscribers\n'
+        'subscriber_id ; идентификатор абонента\n'
+        'region ; регион (см. dwh.regions)'
+    )
+    return SimpleEncoder(DescriptionParser(str(tmp_path)))
+
+
+def test_round_trip(encoder: SimpleEncoder):
+    text = 'select Subscriber_ID from dwh.subscribers where region = 1.'
+    encoded, mapping = encoder.encode(text)
+    assert 'subscriber' not in encoded.lower()
+    assert 'region' not in encoded
+    assert encoder.decode(encoded, mapping) == text
+
+
+def test_partial_names_are_kept(encoder: SimpleEncoder):
+    text = 'subscriber_ids dwh.subscribers.extra regional'
+    encoded, mapping = encoder.encode(text)
+    assert encoded == text
+    assert mapping == {}
+
+
+def test_case_insensitive_match_outside_vocabulary(encoder: SimpleEncoder):
+    # "ſ" matches "s" case-insensitively but doesn't lower to it
+    text = 'ſubscriber_id'
+    encoded, mapping = encoder.encode(text)
+    assert encoded == text
+    assert mapping == {}
+
+
+def test_stream_decoder_joins_split_tokens(encoder: SimpleEncoder):
+    encoded, mapping = encoder.encode('region, subscriber_id')
+    decoder = StreamDecoder(mapping)
+    pieces = [encoded[:3], encoded[3:9], encoded[9:]]
+    decoded = ''.join(decoder.feed(piece) for piece in pieces)
+    assert decoded + decoder.flush() == 'region, subscriber_id'
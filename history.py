@@ -0,0 +1,416 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import datetime
+import gzip
+import json
+import logging
+import os
+from pathlib import Path
+import re
+import shutil
+from typing import Dict, Iterator, List, Optional, Sequence, TextIO
+
+
+logger = logging.getLogger(__name__)
+
+FSYNC_POLICIES = ('batch', 'rotate', 'never')
+
+
+class HistoryWriterError(Exception):
+    pass
+
+
+class HistoryFilterError(Exception):
+    pass
+
+
+def _index_path(segment: Path) -> Path:
+    name = segment.name[:-3] if segment.suffix == '.gz' else segment.name
+    return segment.with_name(f'{name}.idx.json')
+
+
+def _open_segment(segment: Path) -> TextIO:
+    if segment.suffix == '.gz':
+        return gzip.open(segment, 'rt')
+    return open(segment, 'r')
+
+
+@dataclass
+class SegmentIndex:
+    records: int = 0
+    min_ts: Optional[str] = None
+    max_ts: Optional[str] = None
+    users: Dict[str, int] = field(default_factory=dict)
+    modes: Dict[str, int] = field(default_factory=dict)
+
+    def add(self, record: dict):
+        ts = record['ts']
+        self.records += 1
+        self.min_ts = ts if self.min_ts is None else min(self.min_ts, ts)
+        self.max_ts = ts if self.max_ts is None else max(self.max_ts, ts)
+        for key, counter in (('username', self.users), ('mode', self.modes)):
+            value = str(record.get(key))
+            counter[value] = counter.get(value, 0) + 1
+
+    def dump(self, path: Path):
+        tmp = path.with_name(f'{path.name}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.__dict__, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path) -> Optional['SegmentIndex']:
+        try:
+            with open(path, 'r') as f:
+                return cls(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    @classmethod
+    def build(cls, segment: Path) -> 'SegmentIndex':
+        index = cls()
+        for record in _read_records(segment):
+            index.add(record)
+        return index
+
+
+_LEGACY_HEADER = re.compile(
+    r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(?:\.\d+)?)'
+    r':([^:]*):([^:]*):([^:]*):$'
+)
+
+
+def _read_legacy_records(segment: Path) -> Iterator[dict]:
+    # "<time>:<username>:<model>:<mode>:" then "User input:" and
+    # "Model output:", each followed by text of any number of lines. A line
+    # looking like a header starts a record only if "User input:" follows
+    record = None
+    part = None
+    header = None
+    with _open_segment(segment) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if header is not None:
+                if line == 'User input:':
+                    if record is not None:
+                        yield _legacy_record(record)
+                    ts, username, model, mode = header.groups()
+                    record = {'ts': ts, 'username': username,
+                              'model': model, 'mode': mode,
+                              'ask': [], 'answer': []}
+                    part = 'ask'
+                    header = None
+                    continue
+                if record is not None:
+                    record[part].append(header.string)
+                header = None
+            match = _LEGACY_HEADER.match(line)
+            if match:
+                header = match
+            elif record is not None:
+                if part == 'ask' and line == 'Model output:':
+                    part = 'answer'
+                else:
+                    record[part].append(line)
+    if header is not None and record is not None:
+        record[part].append(header.string)
+    if record is not None:
+        yield _legacy_record(record)
+
+
+def _legacy_record(record: dict) -> dict:
+    ts = datetime.datetime.fromisoformat(record['ts'])
+    return {**record,
+            'ts': ts.isoformat(timespec='seconds'),
+            'username': None if record['username'] == 'None'
+                        else record['username'],
+            'ask': '\n'.join(record['ask']),
+            'answer': '\n'.join(record['answer'])}
+
+
+def _read_records(segment: Path) -> Iterator[dict]:
+    with _open_segment(segment) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # the last line of the active segment may be half-written
+                continue
+
+
+@dataclass
+class HistoryFilter:
+    username: Optional[str] = None
+    mode: Optional[str] = None
+    since: Optional[str] = None
+    until: Optional[str] = None
+
+    def may_match(self, index: SegmentIndex) -> bool:
+        if index.records == 0:
+            return False
+        if self.username is not None and self.username not in index.users:
+            return False
+        if self.mode is not None and self.mode not in index.modes:
+            return False
+        if self.since is not None and index.max_ts < self.since:
+            return False
+        if self.until is not None and index.min_ts >= self.until:
+            return False
+        return True
+
+    def match(self, record: dict) -> bool:
+        if self.username is not None and record.get('username') != self.username:
+            return False
+        if self.mode is not None and record.get('mode') != self.mode:
+            return False
+        if self.since is not None and record['ts'] < self.since:
+            return False
+        if self.until is not None and record['ts'] >= self.until:
+            return False
+        return True
+
+
+_PERIOD_PATTERN = re.compile(r'^(\d+)([mhdw])$')
+_RANGE_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2})?\.\.(\d{4}-\d{2}-\d{2})?$')
+_PERIOD_UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
+
+
+def _parse_date(value: str) -> datetime.datetime:
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise HistoryFilterError(f'Invalid date - {value}. '
+                                 'Date must be in YYYY-MM-DD format')
+
+
+def parse_history_filter(args: Sequence[str],
+                         username: str,
+                         modes: Sequence[str],
+                         now: Optional[datetime.datetime] = None) -> HistoryFilter:
+    now = now or datetime.datetime.now()
+    modes = {mode.lower(): mode for mode in modes}
+    history_filter = HistoryFilter()
+    for arg in args:
+        lowered = arg.lower()
+        period = _PERIOD_PATTERN.match(lowered)
+        date_range = _RANGE_PATTERN.match(lowered)
+        if lowered == 'me':
+            history_filter.username = username
+        elif lowered in modes:
+            history_filter.mode = modes[lowered]
+        elif period:
+            delta = datetime.timedelta(
+                **{_PERIOD_UNITS[period[2]]: int(period[1])}
+            )
+            history_filter.since = (now - delta).isoformat()
+        elif date_range:
+            if date_range[1]:
+                history_filter.since = _parse_date(date_range[1]).isoformat()
+            if date_range[2]:
+                until = _parse_date(date_range[2]) + datetime.timedelta(days=1)
+                history_filter.until = until.isoformat()
+        else:
+            day = _parse_date(arg)
+            history_filter.since = day.isoformat()
+            history_filter.until = (day + datetime.timedelta(days=1)).isoformat()
+    return history_filter
+
+
+def export_history(path: str,
+                   history_filter: HistoryFilter,
+                   output: str) -> int:
+    path = Path(path)
+    segments = sorted(
+        p for p in path.parent.glob(f'{path.stem}.*{path.suffix}*')
+        if p.name.endswith((path.suffix, f'{path.suffix}.gz'))
+    )
+    if path.exists():
+        segments.append(path)
+    exported = 0
+    with gzip.open(output, 'wt') as out:
+        for segment in segments:
+            index = SegmentIndex.load(_index_path(segment))
+            if index is not None and not history_filter.may_match(index):
+                continue
+            try:
+                for record in _read_records(segment):
+                    if history_filter.match(record):
+                        out.write(json.dumps(record, ensure_ascii=False))
+                        out.write('\n')
+                        exported += 1
+            except FileNotFoundError:
+                # rotated away while the export was running
+                logger.warning('History segment %s disappeared', segment)
+    return exported
+
+
+class HistoryWriter:
+
+    def __init__(self,
+                 path: str,
+                 batch_size: int = 100,
+                 flush_interval: float = 1.0,
+                 max_segment_size: int = 64 * 1024 * 1024,
+                 compress: bool = True,
+                 fsync_policy: str = 'batch',
+                 legacy_path: Optional[str] = None):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise HistoryWriterError(
+                f'Unknown fsync policy - {fsync_policy}. '
+                f'Policy must be among {FSYNC_POLICIES}'
+            )
+        self._path = Path(path)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_segment_size = max_segment_size
+        self._compress = compress
+        self._fsync_policy = fsync_policy
+        self._legacy_path = None if legacy_path is None else Path(legacy_path)
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='history')
+        self._file: Optional[TextIO] = None
+        self._index: Optional[SegmentIndex] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    async def start(self):
+        if self._legacy_path is not None:
+            await self._in_thread(self._migrate_legacy, self._legacy_path)
+        self._task = asyncio.create_task(self._run())
+
+    def write(self, record: dict):
+        if self._task is None or self._task.done():
+            raise HistoryWriterError('History writer is not running')
+        self._queue.put_nowait(record)
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+        await self._in_thread(self._close_file)
+        self._executor.shutdown(wait=True)
+
+    async def _in_thread(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def _next_batch(self) -> List[Optional[str]]:
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._flush_interval
+        while batch[-1] is not None and len(batch) < self._batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(
+                    await asyncio.wait_for(self._queue.get(), timeout)
+                )
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            stop = batch[-1] is None
+            records = [record for record in batch if record is not None]
+            if records:
+                try:
+                    await self._in_thread(self._write_batch, records)
+                except Exception:
+                    logger.exception('Failed to write %d history records',
+                                     len(records))
+            if stop:
+                return
+
+    def _write_batch(self, records: List[dict]):
+        if self._file is None:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            if self._path.exists():
+                self._index = (SegmentIndex.load(_index_path(self._path))
+                               or SegmentIndex.build(self._path))
+            else:
+                self._index = SegmentIndex()
+            self._file = open(self._path, 'a')
+        lines = []
+        for record in records:
+            lines.append(json.dumps(record, ensure_ascii=False))
+            self._index.add(record)
+        lines.append('')
+        self._file.write('\n'.join(lines))
+        self._file.flush()
+        if self._fsync_policy == 'batch':
+            os.fsync(self._file.fileno())
+        self._index.dump(_index_path(self._path))
+        if self._file.tell() >= self._max_segment_size:
+            self._rotate()
+
+    def _migrate_legacy(self, legacy_path: Path):
+        # the plain text history and its rotated segments are converted
+        # into segments of their own once, the originals are kept renamed
+        legacy = sorted(
+            p for p in legacy_path.parent.glob(
+                f'{legacy_path.stem}.*{legacy_path.suffix}*'
+            )
+            if p.name.endswith((legacy_path.suffix,
+                                f'{legacy_path.suffix}.gz'))
+        )
+        if legacy_path.exists():
+            legacy.append(legacy_path)
+        for source in legacy:
+            index = SegmentIndex()
+            tmp = self._path.with_name(f'{self._path.name}.migrating')
+            with open(tmp, 'w') as out:
+                for record in _read_legacy_records(source):
+                    out.write(json.dumps(record, ensure_ascii=False))
+                    out.write('\n')
+                    index.add(record)
+            if index.records:
+                # named after its first record, so it is sorted before
+                # the segments written since, and converting it again
+                # after a crash can't add a duplicate
+                stamp = datetime.datetime.fromisoformat(
+                    index.min_ts
+                ).strftime('%Y%m%d%H%M%S%f')
+                segment = self._path.with_name(
+                    f'{self._path.stem}.{stamp}{self._path.suffix}'
+                )
+                index.dump(_index_path(segment))
+                os.replace(tmp, segment)
+            else:
+                tmp.unlink()
+            source.rename(source.with_name(f'{source.name}.migrated'))
+            logger.info('Migrated %d history records from %s',
+                        index.records, source)
+
+    def _close_file(self):
+        if self._file is None:
+            return
+        if self._fsync_policy != 'never':
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+    def _rotate(self):
+        self._close_file()
+        stamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+        segment = self._path.with_name(
+            f'{self._path.stem}.{stamp}{self._path.suffix}'
+        )
+        os.replace(_index_path(self._path), _index_path(segment))
+        os.replace(self._path, segment)
+        self._index = None
+        if self._compress:
+            with open(segment, 'rb') as src, \
+                    gzip.open(f'{segment}.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            segment.unlink()
+        logger.info('Rotated history segment %s', segment)
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+from typing import Optional
+
+import aiohttp
+import openai
+
+
+logger = logging.getLogger(__name__)
+
+
+class SessionPoolError(Exception):
+    pass
+
+
+class SessionPool:
+
+    def __init__(self,
+                 pool_size: int,
+                 keepalive_timeout: float,
+                 warm_connections: int = 0):
+        self._pool_size = pool_size
+        self._keepalive_timeout = keepalive_timeout
+        self._warm_connections = warm_connections
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise SessionPoolError('Session pool is not started')
+        return self._session
+
+    @property
+    def started(self) -> bool:
+        return self._session is not None and not self._session.closed
+
+    def bind(self):
+        # `openai.aiosession` is a ContextVar, so it has to be set inside
+        # every task that makes requests, not once at startup
+        openai.aiosession.set(self.session)
+
+    async def start(self):
+        if self.started:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self._pool_size,
+            keepalive_timeout=self._keepalive_timeout
+        )
+        self._session = aiohttp.ClientSession(connector=connector)
+        await self.warm_up(self._warm_connections)
+
+    async def warm_up(self, connections: int):
+        if connections <= 0:
+            return
+        url = f'{openai.api_base}/models'
+        headers = {'Authorization': f'Bearer {openai.api_key}'}
+
+        async def touch():
+            async with self.session.get(url, headers=headers) as response:
+                await response.read()
+
+        results = await asyncio.gather(*(touch() for _ in range(connections)),
+                                       return_exceptions=True)
+        failed = [r for r in results if isinstance(r, Exception)]
+        if failed:
+            logger.warning('Failed to warm %d of %d connections: %s',
+                           len(failed), connections, failed[0])
+        else:
+            logger.info('Warmed %d connections to %s', connections, url)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
@@ -0,0 +1,155 @@
+import asyncio
+from collections import deque
+import logging
+from pathlib import Path
+import time
+from typing import Deque, Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+# rate limits of openai are counted over a minute
+_WINDOW = 60.0
+
+
+class KeyPoolError(Exception):
+    pass
+
+
+class ApiKey:
+
+    def __init__(self, name: str, secret: str, rpm: int, tpm: int):
+        self.name = name
+        self.secret = secret
+        self.rpm = rpm
+        self.tpm = tpm
+        # (sent at, tokens) of the requests of the last minute
+        self._requests: Deque[Tuple[float, int]] = deque()
+        self._tokens = 0
+        self.cooldown_until = 0.0
+        self.rate_limited = 0
+
+    def _expire(self, now: float):
+        while self._requests and self._requests[0][0] <= now - _WINDOW:
+            _, tokens = self._requests.popleft()
+            self._tokens -= tokens
+
+    def headroom(self, cost: int, now: float) -> float:
+        # share of the tighter of the two budgets left after the request,
+        # negative when the request doesn't fit
+        if self.cooldown_until > now:
+            return -1.0
+        self._expire(now)
+        # a request bigger than the whole budget fits into an empty window
+        cost = min(cost, self.tpm)
+        return min((self.rpm - len(self._requests) - 1) / self.rpm,
+                   (self.tpm - self._tokens - cost) / self.tpm)
+
+    def available_at(self, cost: int, now: float) -> float:
+        # when enough of the window expires for the request to fit
+        if self.cooldown_until > now:
+            return self.cooldown_until
+        self._expire(now)
+        requests_over = len(self._requests) + 1 - self.rpm
+        tokens_over = self._tokens + min(cost, self.tpm) - self.tpm
+        at = now
+        expired = 0
+        freed = 0
+        for sent_at, tokens in self._requests:
+            if expired >= requests_over and freed >= tokens_over:
+                break
+            expired += 1
+            freed += tokens
+            at = sent_at + _WINDOW
+        return at
+
+    def spend(self, cost: int, now: float) -> Tuple[float, int]:
+        entry = (now, min(cost, self.tpm))
+        self._requests.append(entry)
+        self._tokens += entry[1]
+        return entry
+
+    def settle(self, entry: Tuple[float, int], tokens: int):
+        # the estimate is replaced with the tokens actually used
+        try:
+            index = self._requests.index(entry)
+        except ValueError:
+            return
+        self._requests[index] = (entry[0], tokens)
+        self._tokens += tokens - entry[1]
+
+    @property
+    def stats(self) -> str:
+        now = time.monotonic()
+        self._expire(now)
+        state = 'cooling down' if self.cooldown_until > now else 'active'
+        return (f'{state}, {len(self._requests)}/{self.rpm} rpm, '
+                f'{self._tokens}/{self.tpm} tpm, '
+                f'{self.rate_limited} rate limited')
+
+
+class KeyPool:
+    # requests go to the key with the most headroom left in its requests
+    # and tokens per minute budgets, a key answering 429 is taken out of
+    # rotation for a while
+
+    def __init__(self, keys: List[ApiKey], cooldown: float):
+        if not keys:
+            raise KeyPoolError('No OpenAI API keys found')
+        self._keys = keys
+        self._cooldown = cooldown
+        self._waits = 0
+
+    @classmethod
+    def load(cls,
+             secrets_dir: Path,
+             pattern: str,
+             rpm: int,
+             tpm: int,
+             cooldown: float) -> 'KeyPool':
+        # a key file holds the key, optionally followed by its own
+        # requests and tokens per minute limits
+        keys = []
+        for path in sorted(secrets_dir.glob(pattern)):
+            fields = path.read_text().split()
+            if not fields:
+                continue
+            key_rpm = int(fields[1]) if len(fields) > 1 else rpm
+            key_tpm = int(fields[2]) if len(fields) > 2 else tpm
+            keys.append(ApiKey(path.stem, fields[0], key_rpm, key_tpm))
+        logger.info('Loaded %d OpenAI API keys', len(keys))
+        return cls(keys, cooldown)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @property
+    def default(self) -> ApiKey:
+        return self._keys[0]
+
+    @property
+    def stats(self) -> Dict[str, str]:
+        return {'waits': str(self._waits),
+                **{key.name: key.stats for key in self._keys}}
+
+    def has_available(self) -> bool:
+        now = time.monotonic()
+        return any(key.cooldown_until <= now for key in self._keys)
+
+    async def acquire(self, cost: int) -> Tuple[ApiKey, Tuple[float, int]]:
+        while True:
+            now = time.monotonic()
+            best = max(self._keys, key=lambda key: key.headroom(cost, now))
+            if best.headroom(cost, now) >= 0:
+                return best, best.spend(cost, now)
+            # every key is out of budget, the request waits for the one
+            # freeing up first instead of being throttled upstream
+            self._waits += 1
+            wake_at = min(key.available_at(cost, now) for key in self._keys)
+            await asyncio.sleep(max(wake_at - now, 0.05))
+
+    def cool_down(self, key: ApiKey, seconds: Optional[float] = None):
+        key.rate_limited += 1
+        key.cooldown_until = time.monotonic() + (seconds or self._cooldown)
+        logger.warning('OpenAI key %s is rate limited, cooling down %.0f s',
+                       key.name, seconds or self._cooldown)
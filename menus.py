@@ -6,6 +6,7 @@ MODE_MENU = (MenuBuilder().set_title('<b>Выбор режима</b>\n\n'
                                      'работать с моделью')
                           .add_button('SQL', 'SQL')
                           .add_button('Free', 'FREE')
+                          .add_button('Сравнение моделей', 'COMPARE')
                           .add_button('Назад', 'BACK')
                           .build())
 
@@ -14,6 +15,7 @@ MODEL_MENU = (MenuBuilder().set_title('<b>Выбор модели</b>\n\n'
                                       'работать')
                            .add_button('GPT-3.5', 'GPT3.5')
                            .add_button('GPT-4', 'GPT4')
+                           .add_button('Авто', 'AUTO')
                            .add_button('Назад', 'BACK')
                            .build())
 
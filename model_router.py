@@ -0,0 +1,204 @@
+from collections import deque
+from contextvars import ContextVar
+from dataclasses import dataclass
+import logging
+import re
+import time
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+from resilience import LatencyTracker
+from tokenizer import count_tokens
+
+
+logger = logging.getLogger(__name__)
+
+AUTO_MODEL = 'auto'
+
+# words of questions which usually need joins, window functions or
+# several steps of aggregation. Stems match from the start of a word
+# only, short ones as whole words: "топ-10" but not "топливо"
+_COMPLEX_PATTERN = re.compile(
+    r'\b(?:join|union|window|partition|rank|объедин|соедин|сравн|кажд|'
+    r'динамик|накопит|нарастающ|оконн|подзапрос|процент|рейтинг)\w*'
+    r'|\bдол(?:я|ю|и|ей)\b|\bтоп(?:\b|(?=\d))',
+    re.IGNORECASE
+)
+
+
+@dataclass(frozen=True)
+class RoutingHint:
+    question: str
+    tables: int = 0
+
+
+# set by the bot around a request, the backend only sees the final prompt
+routing_hint: ContextVar[Optional[RoutingHint]] = ContextVar('routing_hint',
+                                                             default=None)
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self,
+                 window: float,
+                 min_requests: int,
+                 error_threshold: float,
+                 open_seconds: float):
+        self._window = window
+        self._min_requests = min_requests
+        self._error_threshold = error_threshold
+        self._open_seconds = open_seconds
+        # (finished at, succeeded) of the requests within the window
+        self._outcomes: Deque[Tuple[float, bool]] = deque()
+        self._opened_at: Optional[float] = None
+        # when the trial request of the half-open state was let through
+        self._probe_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at < self._open_seconds:
+            return self.OPEN
+        # a single trial request is let through, its outcome decides
+        return self.HALF_OPEN
+
+    @property
+    def available(self) -> bool:
+        state = self.state
+        if state == self.HALF_OPEN:
+            # a trial which never reported back doesn't block the model
+            # forever, another one is let through after `open_seconds`
+            return (self._probe_at is None
+                    or time.monotonic() - self._probe_at
+                    >= self._open_seconds)
+        return state == self.CLOSED
+
+    def admit(self):
+        # called for the request sent to the model, in the half-open
+        # state it becomes the trial and the others are held back
+        if self.state == self.HALF_OPEN and self.available:
+            self._probe_at = time.monotonic()
+
+    @property
+    def error_rate(self) -> float:
+        self._expire(time.monotonic())
+        if not self._outcomes:
+            return 0.0
+        return sum(not ok for _, ok in self._outcomes) / len(self._outcomes)
+
+    def _expire(self, now: float):
+        while self._outcomes and self._outcomes[0][0] < now - self._window:
+            self._outcomes.popleft()
+
+    def record(self, ok: bool):
+        state = self.state
+        if state == self.HALF_OPEN:
+            self._probe_at = None
+            if ok:
+                self._opened_at = None
+                self._outcomes.clear()
+            else:
+                self._opened_at = time.monotonic()
+            return
+        now = time.monotonic()
+        self._outcomes.append((now, ok))
+        self._expire(now)
+        if (state == self.CLOSED
+                and len(self._outcomes) >= self._min_requests
+                and self.error_rate >= self._error_threshold):
+            self._opened_at = now
+
+    @property
+    def stats(self) -> str:
+        state = self.state
+        if state == self.HALF_OPEN and not self.available:
+            state = f'{state} (trial in flight)'
+        return (f'{state}, {self.error_rate:.0%} errors '
+                f'of {len(self._outcomes)}')
+
+
+class ModelRouter:
+    # routes requests of the "auto" model: simple questions go to the
+    # cheapest model, complex ones to the strongest, a model whose circuit
+    # is open or whose p95 latency is over the limit is used only when
+    # nothing healthier is left
+
+    def __init__(self,
+                 models: Sequence[str],
+                 latency: LatencyTracker,
+                 simple_max_tokens: int,
+                 latency_limit: float,
+                 window: float,
+                 min_requests: int,
+                 error_threshold: float,
+                 open_seconds: float):
+        # cheapest first
+        self._models = tuple(models)
+        self._latency = latency
+        self._simple_max_tokens = simple_max_tokens
+        self._latency_limit = latency_limit
+        self._breakers = {model: CircuitBreaker(window,
+                                                min_requests,
+                                                error_threshold,
+                                                open_seconds)
+                          for model in self._models}
+        self._routed = {model: 0 for model in self._models}
+        self._fallbacks = 0
+
+    @property
+    def stats(self) -> Dict[str, str]:
+        return {
+            'fallbacks': str(self._fallbacks),
+            **{model: f'{self._breakers[model].stats}, '
+                      f'{self._routed[model]} routed'
+               for model in self._models}
+        }
+
+    def is_complex(self, hint: RoutingHint) -> bool:
+        return (hint.tables > 1
+                or bool(_COMPLEX_PATTERN.search(hint.question))
+                or count_tokens(hint.question) > self._simple_max_tokens)
+
+    def _healthy(self, model: str) -> bool:
+        if not self._breakers[model].available:
+            return False
+        # streamed requests are tracked by time to the first byte
+        for key in (model, f'{model}:stream'):
+            p95 = self._latency.percentile(key, 0.95, min_samples=5)
+            if p95 is not None and p95 > self._latency_limit:
+                return False
+        return True
+
+    def route(self, message: str) -> List[str]:
+        hint = routing_hint.get() or RoutingHint(message)
+        if self.is_complex(hint):
+            preferred = list(reversed(self._models))
+        else:
+            preferred = list(self._models)
+        healthy = [model for model in preferred if self._healthy(model)]
+        # unhealthy models are still tried last, an open circuit is
+        # better than no answer
+        models = healthy + [model for model in preferred
+                            if model not in healthy]
+        if models[0] != preferred[0]:
+            logger.info('Routing around %s to %s', preferred[0], models[0])
+        self._routed[models[0]] += 1
+        self._breakers[models[0]].admit()
+        return models
+
+    def record(self, model: str, ok: bool):
+        # models set by hand aren't routed but their health is still
+        # useful when "auto" picks them
+        breaker = self._breakers.get(model)
+        if breaker is not None:
+            breaker.record(ok)
+
+    def fall_back(self, model: str, fallback: str):
+        logger.warning('%s failed, falling back to %s', model, fallback)
+        self._fallbacks += 1
+        breaker = self._breakers.get(fallback)
+        if breaker is not None:
+            breaker.admit()
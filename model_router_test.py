@@ -0,0 +1,96 @@
+import pytest
+
+pytest.importorskip('openai')
+
+import model_router
+from model_router import CircuitBreaker
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(model_router, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def breaker(clock: Clock) -> CircuitBreaker:
+    return CircuitBreaker(window=60.0,
+                          min_requests=4,
+                          error_threshold=0.5,
+                          open_seconds=30.0)
+
+
+def open_breaker(breaker: CircuitBreaker):
+    for ok in (True, True, False, False):
+        breaker.record(ok)
+
+
+def test_opens_at_error_threshold(breaker: CircuitBreaker):
+    for ok in (True, True, False):
+        breaker.record(ok)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.available
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.available
+
+
+def test_too_few_requests_dont_open(breaker: CircuitBreaker):
+    for _ in range(3):
+        breaker.record(False)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_old_failures_expire(breaker: CircuitBreaker, clock: Clock):
+    breaker.record(False)
+    breaker.record(False)
+    clock.now += 61
+    breaker.record(False)
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_admits_a_single_trial(breaker: CircuitBreaker,
+                                         clock: Clock):
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.available
+    breaker.admit()
+    # the rest wait for the outcome of the trial
+    assert not breaker.available
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.available
+    assert breaker.error_rate == 0.0
+
+
+def test_failed_trial_reopens(breaker: CircuitBreaker, clock: Clock):
+    open_breaker(breaker)
+    clock.now += 30
+    breaker.admit()
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now += 30
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.available
+
+
+def test_lost_trial_stops_blocking(breaker: CircuitBreaker, clock: Clock):
+    open_breaker(breaker)
+    clock.now += 30
+    breaker.admit()
+    clock.now += 29
+    assert not breaker.available
+    clock.now += 1
+    assert breaker.available
@@ -0,0 +1,228 @@
+import asyncio
+from collections import deque
+import datetime
+import logging
+import re
+import time
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from telegram import Message
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+
+
+logger = logging.getLogger(__name__)
+
+_FENCE_PATTERN = re.compile(r'^```.*$', re.MULTILINE)
+_FENCE_CLOSE = '\n```'
+# preferred places to cut a long text, the best one first
+_SEPARATORS = ('\n\n', '\n', ' ')
+
+
+def split_point(text: str, limit: int) -> int:
+    if len(text) <= limit:
+        return len(text)
+    window = text[:limit]
+    for separator in _SEPARATORS:
+        cut = window.rfind(separator)
+        # a boundary too close to the start would leave a tiny message
+        if cut > limit // 2:
+            return cut + len(separator)
+    return limit
+
+
+def split_message(text: str, limit: int) -> List[str]:
+    chunks = []
+    rest = text
+    fence = None
+    while rest:
+        if fence is not None:
+            # a code block cut in two is reopened in the next message
+            rest = f'{fence}\n{rest}'
+        if len(rest) <= limit:
+            chunk, rest = rest, ''
+        else:
+            # room is left to close a code block
+            cut = split_point(rest, limit - len(_FENCE_CLOSE))
+            chunk, rest = rest[:cut].rstrip(), rest[cut:].lstrip('\n')
+        fences = _FENCE_PATTERN.findall(chunk)
+        fence = fences[-1] if len(fences) % 2 and rest else None
+        if fence is not None:
+            chunk += _FENCE_CLOSE
+        if chunk.strip():
+            chunks.append(chunk)
+    return chunks
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return (self._tokens >= self._capacity
+                and self._blocked_until <= time.monotonic())
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity,
+                           self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def block(self, seconds: float):
+        self._blocked_until = max(self._blocked_until,
+                                  time.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if self._blocked_until > now:
+                await asyncio.sleep(self._blocked_until - now)
+                continue
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+class OutboundSender:
+    # messages of a chat are delivered one by one in the order they were
+    # sent, plain ones waiting in the queue are merged into one message
+
+    def __init__(self,
+                 bot: ExtBot,
+                 max_length: int,
+                 chat_rate: float,
+                 group_rate: float,
+                 chat_burst: float,
+                 global_rate: float,
+                 global_burst: float,
+                 max_retries: int):
+        self._bot = bot
+        self._max_length = max_length
+        self._chat_rate = chat_rate
+        self._group_rate = group_rate
+        self._chat_burst = chat_burst
+        self._max_retries = max_retries
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        # chat id -> (text, send_message arguments, futures of the callers,
+        # whether the text may be merged with others)
+        self._queues: Dict[int, Deque[Tuple[str, dict, List[asyncio.Future], bool]]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._sent = 0
+        self._coalesced = 0
+        self._retries = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'sent': self._sent,
+            'coalesced': self._coalesced,
+            'flood_retries': self._retries,
+            'queued': sum(len(queue) for queue in self._queues.values())
+        }
+
+    async def send(self,
+                   chat_id: int,
+                   text: str,
+                   coalesce: bool = True,
+                   **kwargs) -> Optional[Message]:
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(chat_id, deque())
+        queue.append((text, kwargs, [future], coalesce))
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._drain(chat_id))
+        # the last of the messages the text was split into
+        return await future
+
+    async def edit(self, message: Message, text: str) -> Any:
+        return await self._deliver(message.chat_id, message.edit_text, text)
+
+    async def _drain(self, chat_id: int):
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                text, kwargs, futures = self._coalesce(queue)
+                try:
+                    message = None
+                    for chunk in split_message(text, self._max_length):
+                        message = await self._deliver(chat_id,
+                                                      self._bot.send_message,
+                                                      chat_id,
+                                                      chunk,
+                                                      **kwargs)
+                except Exception as exc:
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(exc)
+                else:
+                    for future in futures:
+                        if not future.done():
+                            future.set_result(message)
+        finally:
+            del self._workers[chat_id]
+            if not queue:
+                del self._queues[chat_id]
+                bucket = self._chat_buckets.get(chat_id)
+                if bucket is not None and bucket.full:
+                    del self._chat_buckets[chat_id]
+
+    def _coalesce(self, queue: Deque) -> Tuple[str, dict, List[asyncio.Future]]:
+        text, kwargs, futures, coalesce = queue.popleft()
+        # messages with markup or formatting are sent as they are
+        if kwargs or not coalesce:
+            return text, kwargs, futures
+        while queue and not queue[0][1] and queue[0][3]:
+            next_text, _, next_futures, _ = queue[0]
+            if len(text) + 2 + len(next_text) > self._max_length:
+                break
+            queue.popleft()
+            text = f'{text}\n\n{next_text}'
+            futures = [*futures, *next_futures]
+            self._coalesced += 1
+        return text, kwargs, futures
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # group chats are allowed far fewer messages than private ones
+            rate = self._group_rate if chat_id < 0 else self._chat_rate
+            bucket = TokenBucket(rate, self._chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _deliver(self,
+                       chat_id: int,
+                       func: Callable[..., Awaitable[Any]],
+                       *args,
+                       **kwargs) -> Any:
+        bucket = self._chat_bucket(chat_id)
+        for attempt in range(self._max_retries + 1):
+            await bucket.acquire()
+            await self._global_bucket.acquire()
+            try:
+                result = await func(*args, **kwargs)
+            except RetryAfter as exc:
+                if attempt == self._max_retries:
+                    raise
+                delay = exc.retry_after
+                if isinstance(delay, datetime.timedelta):
+                    delay = delay.total_seconds()
+                logger.warning('Flood limit in chat %s, retrying in %s s',
+                               chat_id, delay)
+                self._retries += 1
+                bucket.block(delay)
+                continue
+            self._sent += 1
+            return result
+
+    async def close(self):
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip('telegram')
+
+from outbound import TokenBucket, split_message, split_point
+
+
+def unfence(chunks, fence):
+    # the text of the chunks without the fences added at the cuts
+    lines = []
+    for i, chunk in enumerate(chunks):
+        chunk_lines = chunk.split('\n')
+        reopened = i > 0 and chunks[i - 1].endswith('\n```')
+        if reopened and chunk_lines[0] == fence:
+            chunk_lines = chunk_lines[1:]
+        if i + 1 < len(chunks) and chunks[i + 1].startswith(f'{fence}\n'):
+            chunk_lines = chunk_lines[:-1]
+        lines.extend(chunk_lines)
+    return lines
+
+
+def test_short_text_is_one_chunk():
+    assert split_message('hello', 10) == ['hello']
+
+
+def test_chunks_fit_and_nothing_repeats():
+    words = [f'w{i}' for i in range(200)]
+    chunks = split_message(' '.join(words), 50)
+    assert all(len(chunk) <= 50 for chunk in chunks)
+    assert ' '.join(chunks).split() == words
+
+
+def test_cut_prefers_paragraphs():
+    text = 'a' * 30 + '\n\n' + 'b' * 30
+    assert split_message(text, 40) == ['a' * 30, 'b' * 30]
+
+
+def test_boundary_near_start_is_ignored():
+    # cutting after "a" would leave a tiny message
+    assert split_point('a ' + 'b' * 100, 50) == 50
+    assert split_point('a' * 30 + ' ' + 'b' * 100, 50) == 31
+
+
+def test_fenced_code_is_reopened():
+    code = [f'select {i} from dual;' for i in range(30)]
+    text = '\n'.join(['intro', '```sql', *code, '```', 'outro'])
+    chunks = split_message(text, 120)
+    assert len(chunks) > 1
+    for i, chunk in enumerate(chunks):
+        assert len(chunk) <= 120
+        # every message has its code block closed
+        assert chunk.count('```') % 2 == 0
+        if 0 < i < len(chunks) - 1:
+            assert chunk.startswith('```sql\n')
+    assert unfence(chunks, '```sql') == text.split('\n')
+
+
+def test_blank_tail_is_not_sent():
+    # room for a closing fence is kept, so the cut is 4 characters early
+    assert split_message('a' * 16 + '\n' + ' ' * 10, 20) == ['a' * 16]
+    assert split_message('a' * 17, 16) == ['a' * 12, 'a' * 5]
+
+
+def test_bucket_paces_after_burst():
+    async def acquire_all():
+        bucket = TokenBucket(rate=50.0, capacity=2)
+        start = time.monotonic()
+        for _ in range(4):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    # two go at once, the other two wait 1/50 s each
+    assert 0.03 <= asyncio.run(acquire_all()) < 0.5
+
+
+def test_blocked_bucket_is_not_full():
+    bucket = TokenBucket(rate=1.0, capacity=1)
+    assert bucket.full
+    bucket.block(10)
+    assert not bucket.full
@@ -0,0 +1,260 @@
+import asyncio
+from collections import deque
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from openai.error import (
+    APIConnectionError,
+    APIError,
+    RateLimitError,
+    ServiceUnavailableError,
+    Timeout,
+    TryAgain
+)
+
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_ERRORS = (
+    APIConnectionError,
+    APIError,
+    RateLimitError,
+    ServiceUnavailableError,
+    Timeout,
+    TryAgain,
+    asyncio.TimeoutError
+)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class RetryNow(Exception):
+    # the attempt failed on something of the caller's own, like a rate
+    # limited key with other keys left, and is repeated at once without
+    # counting it as an attempt
+    pass
+
+
+class LatencyTracker:
+
+    def __init__(self, window: int):
+        self._window = window
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, key: str, seconds: float):
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self._window)
+        samples.append(seconds)
+
+    def percentile(self,
+                   key: str,
+                   q: float,
+                   min_samples: int = 1) -> Optional[float]:
+        samples = self._samples.get(key, ())
+        if len(samples) < max(min_samples, 1):
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def stats(self) -> Dict[str, str]:
+        return {
+            key: f'p50 {self.percentile(key, 0.5):.2f} s, '
+                 f'p95 {self.percentile(key, 0.95):.2f} s, '
+                 f'{len(samples)} samples'
+            for key, samples in self._samples.items() if samples
+        }
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    headers = getattr(exc, 'headers', None) or {}
+    for header, scale in (('retry-after-ms', 0.001), ('retry-after', 1.0)):
+        value = headers.get(header)
+        if value is None:
+            continue
+        try:
+            return float(value) * scale
+        except ValueError:
+            continue
+    return None
+
+
+class RequestPolicy:
+    # bounds a model request in time: every attempt gets at most
+    # `attempt_timeout` of the time left until the deadline, transient
+    # errors are retried with full jitter exponential backoff (or as long
+    # as the server asked to wait), and an attempt slower than the usual
+    # p95 latency can be hedged with a duplicate, the first answer wins
+
+    def __init__(self,
+                 deadline: float,
+                 attempt_timeout: float,
+                 max_attempts: int,
+                 backoff_base: float,
+                 backoff_max: float,
+                 latency: LatencyTracker,
+                 hedge: bool = False,
+                 hedge_percentile: float = 0.95,
+                 hedge_min_samples: int = 20):
+        self._deadline = deadline
+        self._attempt_timeout = attempt_timeout
+        self._max_attempts = max_attempts
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._latency = latency
+        self._hedge = hedge
+        self._hedge_percentile = hedge_percentile
+        self._hedge_min_samples = hedge_min_samples
+        self._stats = {'retries': 0, 'timeouts': 0, 'hedged': 0,
+                       'hedge_wins': 0, 'failed': 0}
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return dict(self._stats)
+
+    @property
+    def deadline(self) -> float:
+        return self._deadline
+
+    def backoff(self, exc: BaseException, attempt: int) -> float:
+        hint = retry_after(exc)
+        if hint is not None:
+            return hint
+        return random.uniform(0, min(self._backoff_max,
+                                     self._backoff_base * 2 ** attempt))
+
+    def start_deadline(self) -> float:
+        # the absolute deadline of a request made of several calls, like
+        # one falling back to another model
+        return time.monotonic() + self._deadline
+
+    async def call(self,
+                   key: str,
+                   request: Callable[..., Awaitable[Any]],
+                   hedge: Optional[bool] = None,
+                   acquire: Optional[Callable[[], Awaitable[Any]]] = None,
+                   deadline: Optional[float] = None) -> Any:
+        # `acquire` is awaited before every attempt and what it returns is
+        # passed to `request`. Waiting for it, like for rate limit
+        # headroom, is neither timed nor counted against the attempt.
+        # `deadline` is one of `start_deadline`, a call gets its own
+        # deadline without it
+        hedge = self._hedge if hedge is None else hedge
+        if deadline is None:
+            deadline = self.start_deadline()
+        if deadline <= time.monotonic():
+            self._stats['failed'] += 1
+            raise DeadlineExceeded(f'{key}: no time left before the deadline')
+        attempt = 0
+        while True:
+            try:
+                if hedge:
+                    return await self._hedged(key, request, acquire, deadline)
+                return await self._attempt(key, request, acquire, deadline)
+            except RetryNow:
+                continue
+            except RETRYABLE_ERRORS as exc:
+                if isinstance(exc, asyncio.TimeoutError):
+                    self._stats['timeouts'] += 1
+                delay = self.backoff(exc, attempt)
+                attempt += 1
+                if (attempt == self._max_attempts
+                        or time.monotonic() + delay >= deadline):
+                    self._stats['failed'] += 1
+                    raise DeadlineExceeded(
+                        f'{key}: no answer after {attempt} attempts'
+                    ) from exc
+                logger.warning('%s request failed (%r), retry %d in %.1f s',
+                               key, exc, attempt, delay)
+                self._stats['retries'] += 1
+                await asyncio.sleep(delay)
+
+    async def _acquire(self,
+                       key: str,
+                       acquire: Optional[Callable[[], Awaitable[Any]]],
+                       deadline: float) -> tuple:
+        if acquire is None:
+            return ()
+        try:
+            lease = await asyncio.wait_for(acquire(),
+                                           deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            self._stats['failed'] += 1
+            raise DeadlineExceeded(
+                f'{key}: no capacity before the deadline'
+            ) from None
+        return (lease,)
+
+    def _remaining(self, deadline: float) -> float:
+        # a stuck attempt leaves time for another one
+        return min(self._attempt_timeout, deadline - time.monotonic())
+
+    async def _attempt(self,
+                       key: str,
+                       request: Callable[..., Awaitable[Any]],
+                       acquire: Optional[Callable[[], Awaitable[Any]]],
+                       deadline: float,
+                       timeout: Optional[float] = None) -> Any:
+        args = await self._acquire(key, acquire, deadline)
+        if timeout is None:
+            timeout = self._remaining(deadline)
+        return await self._timed(key, lambda: request(*args), timeout)
+
+    async def _timed(self,
+                     key: str,
+                     request: Callable[[], Awaitable[Any]],
+                     timeout: float) -> Any:
+        start = time.monotonic()
+        result = await asyncio.wait_for(request(), timeout)
+        self._latency.record(key, time.monotonic() - start)
+        return result
+
+    async def _hedged(self,
+                      key: str,
+                      request: Callable[..., Awaitable[Any]],
+                      acquire: Optional[Callable[[], Awaitable[Any]]],
+                      deadline: float) -> Any:
+        args = await self._acquire(key, acquire, deadline)
+        timeout = self._remaining(deadline)
+        hedge_after = self._latency.percentile(key,
+                                               self._hedge_percentile,
+                                               self._hedge_min_samples)
+        if hedge_after is None or hedge_after >= timeout:
+            return await self._timed(key, lambda: request(*args), timeout)
+        primary = asyncio.ensure_future(
+            self._timed(key, lambda: request(*args), timeout)
+        )
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                self._stats['hedged'] += 1
+                tasks.add(asyncio.ensure_future(
+                    self._attempt(key, request, acquire, deadline,
+                                  timeout - hedge_after)
+                ))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                # every exception is retrieved, a failed duplicate isn't
+                # reported as never retrieved
+                errors = {task: task.exception() for task in done}
+                for task, exc in errors.items():
+                    if exc is None:
+                        if task is not primary:
+                            self._stats['hedge_wins'] += 1
+                        return task.result()
+                    error = exc
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
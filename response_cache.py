@@ -0,0 +1,155 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+def request_fingerprint(messages: List[dict], params: dict) -> str:
+    payload = json.dumps({'messages': messages, 'params': params},
+                         sort_keys=True,
+                         ensure_ascii=False,
+                         separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+
+    def __init__(self,
+                 max_entries: int,
+                 ttl: float,
+                 max_temperature: float,
+                 disk_path: Optional[str] = None):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._max_temperature = max_temperature
+        # key -> (expires at, response, latency of the original request)
+        self._entries: OrderedDict[str, Tuple[float, str, float]] = OrderedDict()
+        # hash of the table descriptions, part of every key so that answers
+        # stored on disk for other descriptions don't match after a restart
+        self._schema_version = ''
+        self._hits = 0
+        self._misses = 0
+        self._saved_seconds = 0.0
+        self._disk_path = disk_path
+        self._executor = None
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        lookups = self._hits + self._misses
+        return {
+            'entries': len(self._entries),
+            'hits': self._hits,
+            'misses': self._misses,
+            'hit_rate': round(self._hits / lookups, 3) if lookups else 0.0,
+            'saved_seconds': round(self._saved_seconds, 1)
+        }
+
+    def cacheable(self, params: dict) -> bool:
+        # sampling at high temperature is expected to give a new answer
+        # each time, replaying a stored one would change the semantics
+        temperature = params.get('temperature')
+        return temperature is not None and temperature <= self._max_temperature
+
+    async def open(self):
+        # until opened the cache is kept in memory only
+        if self._disk_path is None or self._executor is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='cache')
+        await self._in_thread(self._open, str(self._disk_path))
+
+    def set_schema_version(self, version: str):
+        if self._schema_version and version != self._schema_version:
+            logger.info('Schema changed, dropping %d cached responses',
+                        len(self._entries))
+            self.clear()
+        self._schema_version = version
+
+    def _scoped(self, key: str) -> str:
+        return f'{self._schema_version}:{key}'
+
+    def clear(self):
+        self._entries.clear()
+        if self._executor is not None:
+            self._executor.submit(self._clear_disk)
+
+    async def get(self, key: str) -> Optional[str]:
+        key = self._scoped(key)
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is None and self._executor is not None:
+            entry = await self._in_thread(self._read, key)
+            if entry is not None:
+                self._remember(key, entry)
+        if entry is None or entry[0] < now:
+            if entry is not None:
+                self._entries.pop(key, None)
+            self._misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self._hits += 1
+        self._saved_seconds += entry[2]
+        return entry[1]
+
+    async def put(self, key: str, response: str, latency: float):
+        key = self._scoped(key)
+        entry = (time.time() + self._ttl, response, latency)
+        self._remember(key, entry)
+        if self._executor is not None:
+            await self._in_thread(self._write, key, entry)
+
+    def _remember(self, key: str, entry: Tuple[float, str, float]):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    async def _in_thread(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _open(self, path: str):
+        self._connection = sqlite3.connect(path)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, '
+            'expires REAL NOT NULL, '
+            'response TEXT NOT NULL, '
+            'latency REAL NOT NULL)'
+        )
+        with self._connection:
+            self._connection.execute('DELETE FROM responses WHERE expires < ?',
+                                     (time.time(),))
+
+    def _read(self, key: str) -> Optional[Tuple[float, str, float]]:
+        return self._connection.execute(
+            'SELECT expires, response, latency FROM responses WHERE key = ?',
+            (key,)
+        ).fetchone()
+
+    def _write(self, key: str, entry: Tuple[float, str, float]):
+        with self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses '
+                '(key, expires, response, latency) VALUES (?, ?, ?, ?)',
+                (key, *entry)
+            )
+
+    def _clear_disk(self):
+        with self._connection:
+            self._connection.execute('DELETE FROM responses')
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.submit(self._connection.close).result()
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,196 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+import logging
+import time
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from telegram.constants import ChatAction
+from telegram.error import TelegramError
+from telegram.ext import ExtBot
+
+
+logger = logging.getLogger(__name__)
+
+Job = Callable[[], Awaitable[Any]]
+# share of the latest job in the running average of heavy job durations
+_DURATION_SMOOTHING = 0.2
+
+
+class ChatSchedulerOverloaded(Exception):
+    pass
+
+
+@dataclass
+class ChatQueueStats:
+    jobs: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    def record(self, wait: float):
+        self.jobs += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+
+class ChatScheduler:
+    # updates of one chat run strictly one after another in arrival order.
+    # Heavy jobs (model requests) of different chats run in parallel up to
+    # `max_concurrency` at a time, are admitted to a bounded queue and
+    # dropped when they can't start before `deadline`. Light jobs (commands)
+    # don't take a slot, so they aren't stuck behind model requests of
+    # other chats
+
+    def __init__(self,
+                 bot: ExtBot,
+                 max_concurrency: int,
+                 typing_delay: float,
+                 typing_interval: float,
+                 max_queued: int,
+                 max_queued_per_chat: int,
+                 deadline: float):
+        self._bot = bot
+        self._max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._typing_delay = typing_delay
+        self._typing_interval = typing_interval
+        self._max_queued = max_queued
+        self._max_queued_per_chat = max_queued_per_chat
+        self._deadline = deadline
+        # chat id -> (enqueued at, job, future of the caller, heavy)
+        self._queues: Dict[int, Deque[Tuple[float, Job, asyncio.Future, bool]]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._chat_stats: Dict[int, ChatQueueStats] = {}
+        self._running = 0
+        self._heavy_running = 0
+        self._heavy_queued = 0
+        self._heavy_duration: Optional[float] = None
+        self._shed = {'queue_full': 0, 'chat_queue_full': 0,
+                      'expected_wait': 0, 'deadline': 0}
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        jobs = sum(stats.jobs for stats in self._chat_stats.values())
+        total_wait = sum(stats.total_wait for stats in self._chat_stats.values())
+        return {
+            'running': self._running,
+            'max_concurrency': self._max_concurrency,
+            'queued': sum(len(queue) for queue in self._queues.values()),
+            'active_chats': len(self._workers),
+            'avg_wait_ms': round(total_wait / jobs * 1000, 1) if jobs else 0.0,
+            'max_wait_ms': round(max((stats.max_wait
+                                      for stats in self._chat_stats.values()),
+                                     default=0.0) * 1000, 1),
+            'heavy_queued': self._heavy_queued,
+            **{f'shed_{reason}': count for reason, count in self._shed.items()}
+        }
+
+    def chat_stats(self, chat_id: int) -> Dict[str, float]:
+        stats = self._chat_stats.get(chat_id, ChatQueueStats())
+        return {
+            'depth': len(self._queues.get(chat_id, ())),
+            'jobs': stats.jobs,
+            'avg_wait_ms': round(stats.total_wait / stats.jobs * 1000, 1)
+                           if stats.jobs else 0.0,
+            'max_wait_ms': round(stats.max_wait * 1000, 1)
+        }
+
+    async def run(self, chat_id: int, job: Job, heavy: bool = False) -> Any:
+        if heavy:
+            self._admit(chat_id)
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(chat_id, deque())
+        queue.append((time.monotonic(), job, future, heavy))
+        if heavy:
+            self._heavy_queued += 1
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._drain(chat_id))
+        return await future
+
+    def _admit(self, chat_id: int):
+        if self._heavy_queued >= self._max_queued:
+            self._reject('queue_full')
+        queued = sum(1 for *_, heavy in self._queues.get(chat_id, ()) if heavy)
+        if queued >= self._max_queued_per_chat:
+            self._reject('chat_queue_full')
+        # with every slot busy the queue moves at `max_concurrency` jobs
+        # per average job duration
+        if (self._heavy_running >= self._max_concurrency
+                and self._heavy_duration is not None):
+            expected_wait = ((self._heavy_queued + 1) / self._max_concurrency
+                             * self._heavy_duration)
+            if expected_wait > self._deadline:
+                self._reject('expected_wait')
+
+    def _reject(self, reason: str):
+        self._shed[reason] += 1
+        logger.warning('Model request rejected: %s, %d queued',
+                       reason, self._heavy_queued)
+        raise ChatSchedulerOverloaded(reason)
+
+    async def _drain(self, chat_id: int):
+        queue = self._queues[chat_id]
+        stats = self._chat_stats.setdefault(chat_id, ChatQueueStats())
+        typing = asyncio.create_task(self._show_typing(chat_id))
+        try:
+            while queue:
+                # the job stays in the queue while it waits for a free slot,
+                # so it is counted in the queue depth
+                if queue[0][3]:
+                    async with self._semaphore:
+                        await self._run_next(queue, stats)
+                else:
+                    await self._run_next(queue, stats)
+        finally:
+            typing.cancel()
+            del self._workers[chat_id]
+            if not queue:
+                del self._queues[chat_id]
+
+    async def _run_next(self, queue: Deque, stats: ChatQueueStats):
+        enqueued, job, future, heavy = queue.popleft()
+        if heavy:
+            self._heavy_queued -= 1
+        if future.cancelled():
+            return
+        start = time.monotonic()
+        stats.record(start - enqueued)
+        if heavy and start - enqueued > self._deadline:
+            # the answer would come too late to be of use, the user is
+            # told to retry instead
+            self._shed['deadline'] += 1
+            future.set_exception(ChatSchedulerOverloaded('deadline'))
+            return
+        self._running += 1
+        self._heavy_running += heavy
+        try:
+            result = await job()
+        except Exception as exc:
+            if not future.done():
+                future.set_exception(exc)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self._running -= 1
+            self._heavy_running -= heavy
+        if heavy:
+            duration = time.monotonic() - start
+            if self._heavy_duration is None:
+                self._heavy_duration = duration
+            else:
+                self._heavy_duration += (_DURATION_SMOOTHING
+                                         * (duration - self._heavy_duration))
+
+    async def _show_typing(self, chat_id: int):
+        # quick updates finish before the indicator would show up
+        await asyncio.sleep(self._typing_delay)
+        while True:
+            try:
+                await self._bot.send_chat_action(chat_id, ChatAction.TYPING)
+            except TelegramError as exc:
+                logger.debug('Failed to send typing to %s: %s', chat_id, exc)
+            await asyncio.sleep(self._typing_interval)
+
+    async def close(self):
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
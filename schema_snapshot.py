@@ -0,0 +1,201 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+from pathlib import Path
+import struct
+from typing import Callable, Dict, Iterator, List, Mapping, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MFSCHEMA'
+FORMAT_VERSION = 2
+_PREAMBLE = struct.Struct('>8sII')
+
+ParseFile = Callable[[str], Tuple[str, Tuple[str], str]]
+# columns, source filename, description length, sha256 of the
+# description, description bytes loader
+_Entry = Tuple[Tuple[str], str, int, str, Callable[[], bytes]]
+
+
+class SchemaSnapshotError(Exception):
+    pass
+
+
+def scan_sources(description_dir: Path) -> Dict[str, List[int]]:
+    sources = {}
+    with os.scandir(description_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.txt') and entry.is_file():
+                stat = entry.stat()
+                sources[entry.name] = [stat.st_mtime_ns, stat.st_size]
+    return sources
+
+
+class SchemaSnapshot:
+    # layout: preamble (magic, format version, header length), JSON header
+    # with sources, table index and sorted token vocabulary, then UTF-8
+    # descriptions back to back. Only the header is kept in memory,
+    # descriptions are read from the mapping on demand
+
+    def __init__(self, path: str):
+        self._path = Path(path)
+        with open(self._path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, header_length = _PREAMBLE.unpack_from(self._mmap)
+        except struct.error:
+            raise SchemaSnapshotError(f'Truncated schema snapshot: {path}')
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise SchemaSnapshotError(f'Unknown schema snapshot format: {path}')
+        header_end = _PREAMBLE.size + header_length
+        header = json.loads(self._mmap[_PREAMBLE.size:header_end])
+        self._blob_start = header_end
+        self.sources: Dict[str, List[int]] = header['sources']
+        self.tables: Dict[str, Tuple[int, int, Tuple[str], str]] = {
+            table: (offset, length, tuple(columns), filename)
+            for table, (offset, length, columns, filename, _)
+            in header['tables'].items()
+        }
+        self.hashes: Dict[str, str] = {
+            table: digest for table, (*_, digest) in header['tables'].items()
+        }
+        self.tokens: Tuple[str] = tuple(header['tokens'])
+        # changes only with the descriptions, unlike the file stamps
+        self.digest: str = header['digest']
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def description_bytes(self, table: str) -> bytes:
+        offset, length, _, _ = self.tables[table]
+        start = self._blob_start + offset
+        return self._mmap[start:start + length]
+
+    def description(self, table: str) -> str:
+        return self.description_bytes(table).decode('utf-8')
+
+    @classmethod
+    def load(cls, path: str) -> Optional['SchemaSnapshot']:
+        try:
+            return cls(path)
+        except (OSError, ValueError, KeyError, SchemaSnapshotError) as exc:
+            logger.warning('Ignoring schema snapshot %s: %s', path, exc)
+            return None
+
+    @classmethod
+    def compile(
+        cls,
+        description_dir: Path,
+        path: Path,
+        parse_file: ParseFile,
+        previous: Optional['SchemaSnapshot'] = None
+    ) -> Tuple['SchemaSnapshot', Dict[str, str]]:
+        if previous is None and path.exists():
+            previous = cls.load(path)
+        sources = scan_sources(description_dir)
+        if previous is not None and previous.sources == sources:
+            return previous, {}
+        reusable = {}
+        if previous is not None:
+            reusable = {filename: table for table, (*_, filename)
+                        in previous.tables.items()
+                        if previous.sources.get(filename) == sources.get(filename)}
+        # reused descriptions are only referenced here and copied straight
+        # from the old mapping while writing, so they never sit in memory
+        entries = {}
+        errors = {}
+        for filename in sorted(sources):
+            if filename in reusable:
+                entries[reusable[filename]] = cls._reuse(previous,
+                                                         reusable[filename])
+                continue
+            try:
+                table, columns, desc = parse_file(
+                    str(description_dir / filename)
+                )
+            except (OSError, ValueError) as exc:
+                errors[filename] = str(exc)
+                old = cls._find_by_filename(previous, filename)
+                if old is not None:
+                    entries[old] = cls._reuse(previous, old)
+                continue
+            data = desc.encode('utf-8')
+            entries[table] = (tuple(columns), filename, len(data),
+                              hashlib.sha256(data).hexdigest(),
+                              lambda data=data: data)
+        # a file which failed to parse isn't recorded, so it is parsed and
+        # reported again next time instead of matching the snapshot
+        recorded = {filename: stamp for filename, stamp in sources.items()
+                    if filename not in errors}
+        cls._write(path, recorded, entries)
+        logger.info('Compiled schema snapshot %s: %d tables, %d reparsed',
+                    path, len(entries), len(sources) - len(reusable))
+        return cls(path), errors
+
+    @staticmethod
+    def _reuse(snapshot: 'SchemaSnapshot', table: str) -> _Entry:
+        _, length, columns, filename = snapshot.tables[table]
+        return (columns, filename, length, snapshot.hashes[table],
+                lambda: snapshot.description_bytes(table))
+
+    @staticmethod
+    def _find_by_filename(snapshot: Optional['SchemaSnapshot'],
+                          filename: str) -> Optional[str]:
+        if snapshot is None:
+            return None
+        for table, (*_, table_filename) in snapshot.tables.items():
+            if table_filename == filename:
+                return table
+        return None
+
+    @staticmethod
+    def _write(path: Path,
+               sources: Dict[str, List[int]],
+               entries: Dict[str, _Entry]):
+        tables = {}
+        tokens = set()
+        digest = hashlib.sha256()
+        offset = 0
+        for table in sorted(entries):
+            columns, filename, length, table_hash, _ = entries[table]
+            tables[table] = (offset, length, columns, filename, table_hash)
+            tokens.add(table)
+            tokens.update(columns)
+            digest.update(f'{table}\0{table_hash}\0'.encode('utf-8'))
+            offset += length
+        header = json.dumps({
+            'sources': sources,
+            'tables': tables,
+            'tokens': sorted(tokens),
+            'digest': digest.hexdigest()
+        }, ensure_ascii=False).encode('utf-8')
+        # written next to the target and renamed, so readers still holding
+        # a mapping of the previous snapshot are not affected
+        tmp = path.with_name(f'{path.name}.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+            f.write(header)
+            for table in sorted(entries):
+                f.write(entries[table][4]())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+
+class SnapshotDescriptions(Mapping[str, str]):
+
+    def __init__(self, snapshot: SchemaSnapshot):
+        self._snapshot = snapshot
+
+    def __getitem__(self, table: str) -> str:
+        return self._snapshot.description(table)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._snapshot.tables)
+
+    def __len__(self) -> int:
+        return len(self._snapshot.tables)
@@ -0,0 +1,168 @@
+import hashlib
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+import zlib
+
+import numpy as np
+
+from table_retriever import tokenize
+
+
+_WORD_PATTERN = re.compile(r'\w+')
+_NGRAM = 3
+# terms which change the meaning of a SQL question completely while
+# barely moving its embedding: numbers, encoded table and column names,
+# periods. Questions are only compared when these match exactly
+_GUARD_PATTERN = re.compile(r'unknown#\d+|\d+')
+_GUARD_STEMS = frozenset(tokenize(
+    'январь февраль март апрель май мае мая июнь июль август сентябрь '
+    'октябрь ноябрь декабрь квартал неделя месяц год день сутки час '
+    'january february march april may june july august september '
+    'october november december quarter week month year day hour'
+))
+
+
+def embed(text: str, dim: int) -> np.ndarray:
+    # hashed bag of stemmed words and character trigrams, the trigrams
+    # make "subscribers" and "subscriber" land close to each other
+    vector = np.zeros(dim, dtype=np.float32)
+    features = list(tokenize(text))
+    for word in _WORD_PATTERN.findall(text.lower()):
+        padded = f' {word} '
+        features.extend(padded[i:i + _NGRAM]
+                        for i in range(len(padded) - _NGRAM + 1))
+    for feature in features:
+        h = zlib.crc32(feature.encode('utf-8'))
+        vector[h % dim] += 1.0 if h & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def guard_terms(text: str) -> Tuple[str]:
+    terms = set(_GUARD_PATTERN.findall(text.lower()))
+    terms.update(term for term in tokenize(text) if term in _GUARD_STEMS)
+    return tuple(sorted(terms))
+
+
+def scope_key(*parts: str) -> str:
+    return hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+class _Scope:
+
+    def __init__(self, dim: int):
+        self.vectors = np.empty((4, dim), dtype=np.float32)
+        self.slots: List[int] = []
+
+    def append(self, slot: int, vector: np.ndarray):
+        if len(self.slots) == len(self.vectors):
+            self.vectors = np.concatenate([self.vectors,
+                                           np.empty_like(self.vectors)])
+        self.vectors[len(self.slots)] = vector
+        self.slots.append(slot)
+
+    def remove(self, row: int) -> Optional[int]:
+        # the last row takes the place of the removed one, returns the
+        # slot which moved so that its row can be updated
+        last = len(self.slots) - 1
+        moved = None
+        if row != last:
+            self.vectors[row] = self.vectors[last]
+            self.slots[row] = self.slots[last]
+            moved = self.slots[row]
+        self.slots.pop()
+        return moved
+
+
+class SemanticCache:
+
+    def __init__(self,
+                 capacity: int,
+                 dim: int,
+                 threshold: float,
+                 max_temperature: float):
+        self._capacity = capacity
+        self._dim = dim
+        self._threshold = threshold
+        self._max_temperature = max_temperature
+        self._schema_version: Optional[str] = None
+        self._hits = 0
+        self._misses = 0
+        self._lookup_seconds = 0.0
+        self.clear()
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        lookups = self._hits + self._misses
+        return {
+            'entries': self._size,
+            'scopes': len(self._scopes),
+            'hits': self._hits,
+            'misses': self._misses,
+            'hit_rate': round(self._hits / lookups, 3) if lookups else 0.0,
+            'avg_lookup_ms': round(self._lookup_seconds / lookups * 1000, 3)
+                             if lookups else 0.0
+        }
+
+    def cacheable(self, temperature: Optional[float]) -> bool:
+        return temperature is not None and temperature <= self._max_temperature
+
+    def set_schema_version(self, version: str):
+        if self._schema_version is not None and version != self._schema_version:
+            self.clear()
+        self._schema_version = version
+
+    def clear(self):
+        # per slot: last use time, response, scope and row in that scope;
+        # entries of different scopes are never compared, so a lookup only
+        # scans the contiguous matrix of its own scope
+        self._last_used = np.full(self._capacity, np.inf)
+        self._responses: List[Optional[str]] = [None] * self._capacity
+        self._slot_scopes: List[Optional[str]] = [None] * self._capacity
+        self._slot_rows = np.zeros(self._capacity, dtype=np.int64)
+        self._scopes: Dict[str, _Scope] = {}
+        self._size = 0
+
+    def lookup(self, question: str, scope: str) -> Optional[Tuple[str, float]]:
+        start = time.perf_counter()
+        result = None
+        entries = self._scopes.get(scope_key(scope, *guard_terms(question)))
+        if entries is not None:
+            count = len(entries.slots)
+            similarities = entries.vectors[:count] @ embed(question, self._dim)
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self._threshold:
+                slot = entries.slots[best]
+                self._last_used[slot] = time.monotonic()
+                result = (self._responses[slot], float(similarities[best]))
+        self._lookup_seconds += time.perf_counter() - start
+        if result is None:
+            self._misses += 1
+        else:
+            self._hits += 1
+        return result
+
+    def add(self, question: str, scope: str, response: str):
+        if self._size < self._capacity:
+            slot = self._size
+            self._size += 1
+        else:
+            slot = int(np.argmin(self._last_used))
+            self._release(slot)
+        key = scope_key(scope, *guard_terms(question))
+        entries = self._scopes.setdefault(key, _Scope(self._dim))
+        self._slot_rows[slot] = len(entries.slots)
+        entries.append(slot, embed(question, self._dim))
+        self._last_used[slot] = time.monotonic()
+        self._responses[slot] = response
+        self._slot_scopes[slot] = key
+
+    def _release(self, slot: int):
+        key = self._slot_scopes[slot]
+        entries = self._scopes[key]
+        moved = entries.remove(int(self._slot_rows[slot]))
+        if moved is not None:
+            self._slot_rows[moved] = self._slot_rows[slot]
+        if not entries.slots:
+            del self._scopes[key]
@@ -4,9 +4,154 @@ from pathlib import Path
 PROJECT_DIR = Path(__file__).parent
 CHATBOT_SECRETS = Path(f'{PROJECT_DIR}/chatbot_secrets')
 TABLE_DESCRIPTIONS = Path(f'{CHATBOT_SECRETS}/table_descriptions')
+SCHEMA_SNAPSHOT = Path(f'{CHATBOT_SECRETS}/schema.snapshot')
+RETRIEVAL_INDEX = Path(f'{CHATBOT_SECRETS}/retrieval.npz')
 ALLOWED_USERS = Path(f'{CHATBOT_SECRETS}/allowed_users.txt')
-OPENAI_KEY = Path(f'{CHATBOT_SECRETS}/api_key.key')
+ADMIN_USERS = Path(f'{CHATBOT_SECRETS}/admin_users.txt')
+# every matching file in the secrets directory holds one API key,
+# optionally followed by its requests and tokens per minute limits
+OPENAI_KEYS_PATTERN = 'api_key*.key'
 BOT_KEY = Path(f'{CHATBOT_SECRETS}/tg_key.key')
 SQL_CONTEXT = Path(f'{CHATBOT_SECRETS}/context.txt')
 CONTEXTS_DUMPS = Path(f'{CHATBOT_SECRETS}/contexts.pickle')
-HISTORY = Path(f'{CHATBOT_SECRETS}/history.log')
+CONTEXTS_DB = Path(f'{CHATBOT_SECRETS}/contexts.sqlite3')
+HISTORY = Path(f'{CHATBOT_SECRETS}/history.jsonl')
+# plain text history of older versions, converted once at start
+HISTORY_LEGACY = Path(f'{CHATBOT_SECRETS}/history.log')
+# set to None to keep cached responses in memory only
+RESPONSE_CACHE_DB = Path(f'{CHATBOT_SECRETS}/responses.sqlite3')
+USAGE_DB = Path(f'{CHATBOT_SECRETS}/usage.sqlite3')
+
+OPENAI_POOL_SIZE = 32
+OPENAI_POOL_WARM_CONNECTIONS = 4
+OPENAI_KEEPALIVE_TIMEOUT = 60
+# default limits of a key, per minute
+OPENAI_KEY_RPM = 3500
+OPENAI_KEY_TPM = 90000
+# how long a key answering 429 without retry-after stays out of rotation
+OPENAI_KEY_COOLDOWN = 20.0
+
+CONTEXTS_CACHE_SIZE = 1000
+CONTEXTS_IDLE_TIMEOUT = 30 * 60
+CONTEXTS_SWEEP_INTERVAL = 60
+
+HISTORY_BATCH_SIZE = 100
+HISTORY_FLUSH_INTERVAL = 1.0
+HISTORY_SEGMENT_SIZE = 64 * 1024 * 1024
+HISTORY_COMPRESS_SEGMENTS = True
+# 'batch' - fsync after every flushed batch, 'rotate' - only when a segment
+# is closed, 'never' - leave it to the OS
+HISTORY_FSYNC_POLICY = 'batch'
+
+DESCRIPTIONS_POLL_INTERVAL = 10.0
+
+RETRIEVAL_TOP_K = 3
+# scores are normalized to the best single term match: about 1 for a word
+# found only in the description of that table, near 0 for a word found
+# in every table (like "таблица"), a few matched words add up above 1
+RETRIEVAL_MIN_SCORE = 0.25
+
+# max tokens of a single table description attached to a SQL question
+COLUMN_PRUNING_TOKEN_BUDGET = 1500
+# encoded descriptions of this many most recently used tables are kept
+ENCODED_TABLES_CACHE_SIZE = 200
+
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16384,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+# room left for the completion when `max_tokens` is not set
+COMPLETION_TOKENS_RESERVE = 512
+MESSAGE_TOKENS_OVERHEAD = 4
+# default cap on the tokens of stored turns sent with a request, every
+# chat can change it with /context_tokens. The window still limits it
+CONTEXT_HISTORY_TOKENS = 500
+# stored turns are trimmed to the token budget, this only keeps a chat
+# of very short messages from growing without bound
+CONTEXT_MAX_MESSAGES = 200
+
+SUMMARY_MODEL = 'gpt-3.5-turbo'
+SUMMARY_MAX_TOKENS = 300
+# evicted turns folded into the summary by one request
+SUMMARY_BATCH_TOKENS = 2000
+# turns left waiting after failed folds, the oldest beyond it are dropped
+SUMMARY_MAX_PENDING_TOKENS = 4000
+
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+RESPONSE_CACHE_TTL = 24 * 60 * 60
+# answers sampled at a higher temperature are never cached
+RESPONSE_CACHE_MAX_TEMPERATURE = 0.3
+
+SEMANTIC_CACHE_CAPACITY = 100000
+SEMANTIC_CACHE_DIM = 128
+# cosine similarity of question embeddings needed for a hit
+SEMANTIC_CACHE_THRESHOLD = 0.9
+SEMANTIC_CACHE_MAX_TEMPERATURE = 0.3
+
+# answers are shown while they are generated by editing one message
+STREAM_RESPONSES = True
+# telegram allows about one edit per second in a chat
+STREAM_EDIT_INTERVAL = 1.0
+
+# telegram flood limits: about a message per second in a private chat,
+# 20 per minute in a group and 30 per second overall
+OUTBOUND_CHAT_RATE = 1.0
+OUTBOUND_GROUP_RATE = 20 / 60
+OUTBOUND_CHAT_BURST = 3
+OUTBOUND_GLOBAL_RATE = 30.0
+OUTBOUND_GLOBAL_BURST = 30
+OUTBOUND_MAX_RETRIES = 3
+
+# chats handled at the same time, updates of one chat always go in order
+SCHEDULER_MAX_CONCURRENCY = OPENAI_POOL_SIZE
+# updates accepted from telegram before they are queued per chat
+UPDATES_MAX_PENDING = 256
+SCHEDULER_TYPING_DELAY = 0.5
+# telegram shows the typing status for 5 seconds
+SCHEDULER_TYPING_INTERVAL = 4.5
+
+# model requests waiting for a free slot, beyond that they are rejected
+ADMISSION_MAX_QUEUED = 64
+ADMISSION_MAX_QUEUED_PER_CHAT = 3
+# a request which can't start within this many seconds is rejected
+ADMISSION_DEADLINE = 60.0
+
+# a model request with all its retries has to finish within this time
+OPENAI_REQUEST_DEADLINE = 120.0
+OPENAI_ATTEMPT_TIMEOUT = 60.0
+OPENAI_MAX_ATTEMPTS = 4
+OPENAI_BACKOFF_BASE = 1.0
+OPENAI_BACKOFF_MAX = 20.0
+# a duplicate request is sent once an answer takes longer than the p95
+# latency of the model, it costs tokens so it is off by default
+OPENAI_HEDGE_REQUESTS = False
+OPENAI_HEDGE_PERCENTILE = 0.95
+OPENAI_HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+# models the "auto" model chooses from, the cheapest first
+ROUTER_MODELS = ('gpt-3.5-turbo', 'gpt-4')
+# longer questions go to the strongest model
+ROUTER_SIMPLE_MAX_TOKENS = 40
+# a model slower than this at p95 is avoided while another one is healthy
+ROUTER_LATENCY_LIMIT = 45.0
+ROUTER_MAX_FALLBACKS = 1
+# circuit breaker: opens when at least ROUTER_ERROR_THRESHOLD of the
+# requests of the last ROUTER_WINDOW seconds failed, then lets requests
+# through again after ROUTER_OPEN_SECONDS
+ROUTER_WINDOW = 300.0
+ROUTER_MIN_REQUESTS = 5
+ROUTER_ERROR_THRESHOLD = 0.5
+ROUTER_OPEN_SECONDS = 60.0
+
+# prompt and completion tokens a user may spend a day, None - no limit
+USAGE_DAILY_TOKEN_QUOTA = 200000
+# username -> own daily quota, overrides the default one
+USAGE_USER_TOKEN_QUOTAS = {}
+USAGE_FLUSH_INTERVAL = 30.0
+
+# models a question is sent to in the COMPARE mode
+COMPARE_MODELS = ('gpt-3.5-turbo', 'gpt-4')
@@ -0,0 +1,58 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+
+class SingleFlight:
+    # identical requests started while one is still running wait for the
+    # running one instead of going upstream again
+
+    def __init__(self):
+        # key -> (upstream task, number of callers waiting for it)
+        self._calls: Dict[str, Tuple[asyncio.Task, int]] = {}
+        self._started = 0
+        self._saved = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'in_flight': len(self._calls),
+            'started': self._started,
+            'saved': self._saved
+        }
+
+    async def run(self, key: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        if key in self._calls:
+            task, waiters = self._calls[key]
+            self._saved += 1
+        else:
+            # a separate task, so that a caller going away doesn't cancel
+            # the request for the others
+            task, waiters = asyncio.ensure_future(call()), 0
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self._started += 1
+        self._calls[key] = (task, waiters + 1)
+        try:
+            # errors are raised to every waiter, a retrieved exception
+            # isn't logged as never retrieved
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done():
+                self._leave(key, task)
+            raise
+
+    def _leave(self, key: str, task: asyncio.Task):
+        _, waiters = self._calls[key]
+        if waiters > 1:
+            self._calls[key] = (task, waiters - 1)
+        else:
+            # nobody waits for the answer anymore. The entry goes first, a
+            # caller coming before the task finishes starts a new one
+            # instead of joining a cancelled task
+            del self._calls[key]
+            task.cancel()
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if key in self._calls and self._calls[key][0] is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,221 @@
+from collections import Counter
+import copy
+import logging
+import os
+from pathlib import Path
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from description import DescriptionParser
+
+
+logger = logging.getLogger(__name__)
+
+
+_WORD_PATTERN = re.compile(r'\w+')
+# crude stemming: russian column comments are heavily inflected,
+# "абонентов" and "абоненту" should hit the same term
+_STEM_LENGTH = 6
+
+
+def tokenize(text: str) -> List[str]:
+    terms = []
+    for word in _WORD_PATTERN.findall(text.lower()):
+        terms.append(word[:_STEM_LENGTH])
+        if '_' in word:
+            terms.extend(part[:_STEM_LENGTH]
+                         for part in word.split('_') if part)
+    return terms
+
+
+class TableRetriever:
+
+    def __init__(self,
+                 description_parser: DescriptionParser,
+                 k1: float = 1.5,
+                 b: float = 0.75):
+        self._k1 = k1
+        self._b = b
+        self._tables = sorted(description_parser.tables)
+        self._vocabulary: Dict[str, int] = {}
+        terms, docs, tfs, doc_lengths = self._tokenize_tables(
+            description_parser, enumerate(self._tables), len(self._tables)
+        )
+        self._set_postings(terms, docs, tfs, doc_lengths)
+
+    def save(self, path: Path, digest: str):
+        # `digest` is of the descriptions the index was built from. Written
+        # next to the target and renamed, like the schema snapshot
+        terms = sorted(self._vocabulary, key=self._vocabulary.get)
+        tmp = path.with_name(f'{path.name}.tmp')
+        with open(tmp, 'wb') as f:
+            np.savez(f,
+                     digest=np.array(digest),
+                     tables=np.array(self._tables, dtype=str),
+                     terms=np.array(terms, dtype=str),
+                     indptr=self._indptr,
+                     docs=self._docs,
+                     tfs=self._tfs,
+                     doc_lengths=self._doc_lengths)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls,
+             path: Path,
+             digest: str,
+             k1: float = 1.5,
+             b: float = 0.75) -> Optional['TableRetriever']:
+        # an index saved for the same descriptions, so none of them has to
+        # be read to start
+        try:
+            with np.load(path) as data:
+                if str(data['digest']) != digest:
+                    return None
+                retriever = cls.__new__(cls)
+                retriever._k1 = k1
+                retriever._b = b
+                retriever._tables = data['tables'].tolist()
+                retriever._vocabulary = {
+                    term: term_id
+                    for term_id, term in enumerate(data['terms'].tolist())
+                }
+                retriever._indptr = data['indptr']
+                retriever._docs = data['docs']
+                retriever._tfs = data['tfs']
+                retriever._doc_lengths = data['doc_lengths']
+        except (OSError, ValueError, KeyError) as exc:
+            logger.warning('Ignoring retrieval index %s: %s', path, exc)
+            return None
+        retriever._build_index()
+        return retriever
+
+    def updated(self,
+                description_parser: DescriptionParser,
+                tables: Iterable[str]) -> 'TableRetriever':
+        # a retriever for a parser with some tables changed: only their
+        # descriptions are tokenized again, postings of the rest are
+        # carried over with the documents renumbered
+        tables = {table.lower() for table in tables}
+        retriever = copy.copy(self)
+        retriever._tables = sorted(description_parser.tables)
+        retriever._vocabulary = dict(self._vocabulary)
+        new_docs = {table: doc for doc, table in enumerate(retriever._tables)}
+        old_docs = set(self._tables)
+        # old document -> new one, -1 for the dropped and changed tables
+        remap = np.array([-1 if table in tables else new_docs.get(table, -1)
+                          for table in self._tables], dtype=np.int32)
+        kept = remap[self._docs] >= 0
+        old_terms = np.repeat(
+            np.arange(len(self._vocabulary), dtype=np.int32),
+            np.diff(self._indptr)
+        )
+        changed = [(doc, table) for doc, table in enumerate(retriever._tables)
+                   if table in tables or table not in old_docs]
+        terms, docs, tfs, doc_lengths = retriever._tokenize_tables(
+            description_parser, changed, len(retriever._tables)
+        )
+        carried = remap >= 0
+        doc_lengths[remap[carried]] = self._doc_lengths[carried]
+        retriever._set_postings(
+            np.concatenate([old_terms[kept], terms]),
+            np.concatenate([remap[self._docs[kept]], docs]),
+            np.concatenate([self._tfs[kept], tfs]),
+            doc_lengths
+        )
+        return retriever
+
+    def _tokenize_tables(
+        self,
+        description_parser: DescriptionParser,
+        tables: Iterable[Tuple[int, str]],
+        n_docs: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        # postings of the given documents as (term, doc, tf) columns
+        terms, docs, tfs = [], [], []
+        doc_lengths = np.zeros(n_docs, dtype=np.float32)
+        for doc, table in tables:
+            counts = Counter(
+                tokenize(description_parser.get_table_description(table))
+            )
+            doc_lengths[doc] = sum(counts.values())
+            for term, tf in counts.items():
+                term_id = self._vocabulary.setdefault(term,
+                                                      len(self._vocabulary))
+                terms.append(term_id)
+                docs.append(doc)
+                tfs.append(tf)
+        return (np.array(terms, dtype=np.int32),
+                np.array(docs, dtype=np.int32),
+                np.array(tfs, dtype=np.float32),
+                doc_lengths)
+
+    def _set_postings(self,
+                      terms: np.ndarray,
+                      docs: np.ndarray,
+                      tfs: np.ndarray,
+                      doc_lengths: np.ndarray):
+        # terms left without postings are dropped, so an index updated
+        # many times scores the same as one built from scratch
+        counts = np.bincount(terms, minlength=len(self._vocabulary))
+        if (counts == 0).any():
+            alive = counts > 0
+            new_ids = np.cumsum(alive) - 1
+            self._vocabulary = {term: int(new_ids[term_id])
+                                for term, term_id in self._vocabulary.items()
+                                if alive[term_id]}
+            terms = new_ids[terms].astype(np.int32)
+            counts = counts[alive]
+        # inverted index in CSR layout: postings of term t are
+        # _docs[_indptr[t]:_indptr[t + 1]]
+        order = np.lexsort((docs, terms))
+        self._indptr = np.concatenate([[0], np.cumsum(counts)])
+        self._docs = docs[order]
+        self._tfs = tfs[order]
+        self._doc_lengths = doc_lengths
+        self._build_index()
+
+    def _build_index(self):
+        n_terms = len(self._vocabulary)
+        n_docs = len(self._tables)
+        df = np.diff(self._indptr).astype(np.float32)
+        self._idf = np.log1p((n_docs - df + 0.5) / (df + 0.5))
+        avg_length = self._doc_lengths.mean() if n_docs else 0.0
+        norm = self._k1 * (1 - self._b + self._b * self._doc_lengths
+                           / max(avg_length, 1.0))
+        # tf part of bm25 doesn't depend on the query, so it is
+        # precomputed per posting
+        self._weights = (self._tfs * (self._k1 + 1)
+                         / (self._tfs + norm[self._docs])).astype(np.float32)
+        # raw bm25 grows with the corpus, scores are divided by the best
+        # a single term can get: a word found in one table only, repeated
+        # often, scores about 1, a word found in every table near 0
+        self._max_term_score = float(self._idf.max() * (self._k1 + 1)
+                                     if n_terms else 1.0)
+
+    @property
+    def size(self) -> int:
+        return len(self._tables)
+
+    def search(self,
+               query: str,
+               top_k: int,
+               min_score: float = 0.0) -> List[Tuple[str, float]]:
+        term_ids = [self._vocabulary[term] for term in set(tokenize(query))
+                    if term in self._vocabulary]
+        if not term_ids or not self._tables:
+            return []
+        slices = [slice(self._indptr[t], self._indptr[t + 1])
+                  for t in term_ids]
+        docs = np.concatenate([self._docs[s] for s in slices])
+        weights = np.concatenate([self._weights[s] * self._idf[t]
+                                  for s, t in zip(slices, term_ids)])
+        scores = np.bincount(docs, weights=weights,
+                             minlength=len(self._tables))
+        scores /= self._max_term_score
+        top_k = min(top_k, len(self._tables))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [(self._tables[doc], float(scores[doc]))
+                for doc in best if scores[doc] > min_score]
@@ -1,13 +1,15 @@
+import asyncio
 import datetime
 import functools
 import logging
 from pathlib import Path
-import pickle
 import re
-from typing import Callable, Dict
+import tempfile
+import time
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
 
-import aiofiles
-from telegram import Update
+from telegram import Message, Update
+from telegram.error import TelegramError
 from telegram.constants import ParseMode
 from telegram.ext import (
     Application,
@@ -19,19 +21,85 @@ from telegram.ext import (
     ExtBot
 )
 
-from backends import AbstractBackend, SQLBackend, FREEBackend
-from chat_context import BackendSwitcher, ChatContext
+from backends import (
+    AbstractBackend,
+    ChatGPTBackend,
+    CompareBackend,
+    FREEBackend,
+    ModelRequestError,
+    SQLBackend,
+    in_flight,
+    key_pool,
+    latency,
+    model_router,
+    request_policy,
+    response_cache,
+    session_pool,
+    usage_meter
+)
+from chat_context import BackendSwitcher, ChatContext, SwitcherException
+from column_pruner import ColumnPruner
+from context_store import ChatContextStore
 from description import DescriptionParser
-from encoder import SimpleEncoder
+from description_watcher import DescriptionWatcher, Schema
+from encoder import SimpleEncoder, StreamDecoder
+from history import (
+    HistoryFilterError,
+    HistoryWriter,
+    export_history,
+    parse_history_filter
+)
 from menu import Menu
 from menus import MAIN_MENU, MODE_MENU, MODEL_MENU
+from model_router import AUTO_MODEL, RoutingHint, routing_hint
+from outbound import OutboundSender, split_point
+from scheduler import ChatScheduler, ChatSchedulerOverloaded
+from semantic_cache import SemanticCache, scope_key
+from usage import UsageQuotaExceeded, UsageScope, usage_scope
 from settings import (
+    ADMIN_USERS,
+    ADMISSION_DEADLINE,
+    ADMISSION_MAX_QUEUED,
+    ADMISSION_MAX_QUEUED_PER_CHAT,
     ALLOWED_USERS,
     BOT_KEY,
+    COLUMN_PRUNING_TOKEN_BUDGET,
+    CONTEXTS_CACHE_SIZE,
+    CONTEXTS_DB,
     CONTEXTS_DUMPS,
+    CONTEXTS_IDLE_TIMEOUT,
+    CONTEXTS_SWEEP_INTERVAL,
+    DESCRIPTIONS_POLL_INTERVAL,
+    ENCODED_TABLES_CACHE_SIZE,
     HISTORY,
+    HISTORY_BATCH_SIZE,
+    HISTORY_COMPRESS_SEGMENTS,
+    HISTORY_FLUSH_INTERVAL,
+    HISTORY_FSYNC_POLICY,
+    HISTORY_LEGACY,
+    HISTORY_SEGMENT_SIZE,
+    OUTBOUND_CHAT_BURST,
+    OUTBOUND_CHAT_RATE,
+    OUTBOUND_GLOBAL_BURST,
+    OUTBOUND_GLOBAL_RATE,
+    OUTBOUND_GROUP_RATE,
+    OUTBOUND_MAX_RETRIES,
+    RETRIEVAL_INDEX,
+    RETRIEVAL_MIN_SCORE,
+    RETRIEVAL_TOP_K,
+    SCHEDULER_MAX_CONCURRENCY,
+    SCHEDULER_TYPING_DELAY,
+    SCHEDULER_TYPING_INTERVAL,
+    SCHEMA_SNAPSHOT,
+    SEMANTIC_CACHE_CAPACITY,
+    SEMANTIC_CACHE_DIM,
+    SEMANTIC_CACHE_MAX_TEMPERATURE,
+    SEMANTIC_CACHE_THRESHOLD,
     SQL_CONTEXT,
-    TABLE_DESCRIPTIONS
+    STREAM_EDIT_INTERVAL,
+    TABLE_DESCRIPTIONS,
+    UPDATES_MAX_PENDING,
+    USAGE_FLUSH_INTERVAL
 ) 
 
 
@@ -44,6 +112,15 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 MAX_MESSAGE_LENGTH=4096
+STREAM_PLACEHOLDER = '…'
+BUSY_MESSAGE = 'Сейчас слишком много запросов, попробуй повторить чуть позже'
+QUOTA_MESSAGE = ('Дневной лимит токенов исчерпан: использовано {used} '
+                 'из {quota}. Попробуй завтра')
+USAGE_PERIOD_PATTERN = re.compile(r'^(\d+)d$')
+COMPARE_ANSWER = ('{model} - {latency:.1f} с, '
+                  '{prompt_tokens} + {completion_tokens} токенов\n\n{answer}')
+COMPARE_FAILURE = '{model} - ошибка через {latency:.1f} с\n\n{answer}'
+NOT_ALLOWED_MESSAGE = 'You are not allowed to use this bot'
 START_MESSAGE = """
 Привет! Я чат-бот Мегафона.
 Прежде, чем начать работу со мной, 
@@ -59,17 +136,27 @@ AVAILABLE_COMMANDS = """
 
 /settings - показать значения текущих параметров
 
-/history - выгрузить историю общения с моделями
+/history [me] [sql|free|compare] [7d|2023-10-01..2023-10-31] - выгрузить историю общения с моделями. Можно отфильтровать по своему имени, режиму и периоду
+
+/stats - показать статистику работы бота
+
+/usage [7d] [all] - показать расход токенов за период (по умолчанию за сегодня). `all` - по всем пользователям (для администраторов)
+
+/reload_descriptions - перечитать описания таблиц (для администраторов)
 
 /menu - открыть главное меню
 
 /mode - показать текущий режим работы
 
-/model_name <value> - установить название модели
+/model_name <value> - установить название модели (`auto` - выбирать автоматически)
 
 /context - показать текущий контекст
 
-/context_depth <value> - установить глубину контекста. От 1 до 30
+/context_tokens <value> - сколько токенов прошлых реплик отправлять модели. 0 - не отправлять
+
+/summary <on|off> - сжимать старые реплики режима FREE в краткое содержание
+
+/stream <on|off> - показывать ответ по мере генерации
 
 /max_tokens <value> - установить значение параметра модели `max_tokens`
 
@@ -88,6 +175,9 @@ BOT_TOKEN = BOT_KEY.read_text()
 
 ALLOWED_USERS = [user for user in ALLOWED_USERS.read_text().split('\n')]
 
+ADMIN_USERS = ([user for user in ADMIN_USERS.read_text().split('\n')]
+               if ADMIN_USERS.exists() else [])
+
 
 class BotHandlerException(Exception):
     pass
@@ -101,114 +191,218 @@ class BotHandler:
                  mode_menu: Menu,
                  model_menu: Menu,
                  switcher_factory: Callable[[str], BackendSwitcher],
-                 encoder: SimpleEncoder,
-                 description_parser: DescriptionParser):
+                 description_watcher: DescriptionWatcher):
         self.main_menu = main_menu
         self.mode_menu = mode_menu
         self.model_menu = model_menu
         self._switcher_factory = switcher_factory
-        self._contexts_dump_path = str(CONTEXTS_DUMPS)
-        self._chat_contexts = self.load_contexts(self._contexts_dump_path)
+        self._store = ChatContextStore(CONTEXTS_DB,
+                                       legacy_dump_path=CONTEXTS_DUMPS,
+                                       cache_size=CONTEXTS_CACHE_SIZE,
+                                       idle_timeout=CONTEXTS_IDLE_TIMEOUT)
+        self._sweeper: Optional[asyncio.Task] = None
         self._bot = bot
+        self._sender = OutboundSender(
+            bot,
+            max_length=MAX_MESSAGE_LENGTH,
+            chat_rate=OUTBOUND_CHAT_RATE,
+            group_rate=OUTBOUND_GROUP_RATE,
+            chat_burst=OUTBOUND_CHAT_BURST,
+            global_rate=OUTBOUND_GLOBAL_RATE,
+            global_burst=OUTBOUND_GLOBAL_BURST,
+            max_retries=OUTBOUND_MAX_RETRIES
+        )
+        self._scheduler = ChatScheduler(
+            bot,
+            max_concurrency=SCHEDULER_MAX_CONCURRENCY,
+            typing_delay=SCHEDULER_TYPING_DELAY,
+            typing_interval=SCHEDULER_TYPING_INTERVAL,
+            max_queued=ADMISSION_MAX_QUEUED,
+            max_queued_per_chat=ADMISSION_MAX_QUEUED_PER_CHAT,
+            deadline=ADMISSION_DEADLINE
+        )
         self._history_file_name = str(HISTORY)
-        self._encoder = encoder
-        self._description_parser = description_parser
+        self._history = HistoryWriter(
+            self._history_file_name,
+            batch_size=HISTORY_BATCH_SIZE,
+            flush_interval=HISTORY_FLUSH_INTERVAL,
+            max_segment_size=HISTORY_SEGMENT_SIZE,
+            compress=HISTORY_COMPRESS_SEGMENTS,
+            fsync_policy=HISTORY_FSYNC_POLICY,
+            legacy_path=HISTORY_LEGACY
+        )
+        self._description_watcher = description_watcher
+        self._column_pruner = ColumnPruner(COLUMN_PRUNING_TOKEN_BUDGET)
+        self._semantic_cache = SemanticCache(
+            capacity=SEMANTIC_CACHE_CAPACITY,
+            dim=SEMANTIC_CACHE_DIM,
+            threshold=SEMANTIC_CACHE_THRESHOLD,
+            max_temperature=SEMANTIC_CACHE_MAX_TEMPERATURE
+        )
+        self._watcher_task: Optional[asyncio.Task] = None
+        self._usage_flusher: Optional[asyncio.Task] = None
     
-    async def _save_ask_to_history(self,
-                                   context: ChatContext,
-                                   ask: str,
-                                   answer: str):
-        async with aiofiles.open(self._history_file_name, 'a') as f:
-            await f.write(f'{datetime.datetime.now()}:'
-                          f'{context.username}:'
-                          f'{context.switcher.model_name}:'
-                          f'{context.switcher.mode}:\n'
-                          'User input:\n'
-                          f'{ask}\n'
-                          'Model output:\n'
-                          f'{answer}\n')
-
-    def _create_new_chat_context(self, update: Update, context: CallbackContext):
-        self._chat_contexts[context._chat_id] = ChatContext( # maybe use dependency injection
+    def _save_ask_to_history(self,
+                             context: ChatContext,
+                             ask: str,
+                             answer: str,
+                             **extra):
+        self._history.write({
+            'ts': datetime.datetime.now().isoformat(timespec='seconds'),
+            'username': context.username,
+            'model': context.switcher.model_name,
+            'mode': context.switcher.mode,
+            'ask': ask,
+            'answer': answer,
+            **extra
+        })
+
+    def _create_new_chat_context(self,
+                                 update: Update,
+                                 context: CallbackContext) -> ChatContext:
+        chat_context = ChatContext( # maybe use dependency injection
             chat_id=context._chat_id,
             username=update.message.from_user.username, # make unique (remove message)
             switcher=self._switcher_factory(update.message.from_user.username)
         )
+        self._store.put(context._chat_id, chat_context)
+        return chat_context
 
-    def get_chat_context(self,
-                         update: Update,
-                         context: CallbackContext) -> ChatContext:
-        if context._chat_id not in self._chat_contexts:
-            self._create_new_chat_context(update, context)
-        return self._chat_contexts[context._chat_id]
-    
-    def dump_contexts(self, dump_path: str):
-        with open(dump_path, 'wb') as f:
-            pickle.dump(self._chat_contexts, f)
-    
-    @staticmethod
-    def load_contexts(dump_path: str):
-        if Path(dump_path).exists():
-            with open(dump_path, 'rb') as f:
+    async def get_chat_context(self,
+                               update: Update,
+                               context: CallbackContext) -> ChatContext:
+        chat_context = await self._store.acquire(context._chat_id)
+        if chat_context is None:
+            chat_context = self._create_new_chat_context(update, context)
+        return chat_context
+
+    async def start(self):
+        await self._history.start()
+        self._watcher_task = asyncio.create_task(
+            self._description_watcher.watch_forever()
+        )
+        self._sweeper = asyncio.create_task(
+            self._store.sweep_forever(CONTEXTS_SWEEP_INTERVAL)
+        )
+        self._usage_flusher = asyncio.create_task(
+            usage_meter.flush_forever(USAGE_FLUSH_INTERVAL)
+        )
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+        if self._watcher_task is not None:
+            self._watcher_task.cancel()
+        if self._usage_flusher is not None:
+            self._usage_flusher.cancel()
+        await self._scheduler.close()
+        await self._sender.close()
+        await self._history.close()
+        await self._store.close()
+
+    def chat_context(func: Optional[Callable] = None,
+                     *,
+                     heavy: bool = False,
+                     ordered: bool = True):
+        # heavy handlers make model requests and go through admission
+        # control, the rest are handled in the fast lane. Handlers which
+        # don't change the chat settings aren't `ordered`: they don't wait
+        # in the chat queue behind a model request. Those showing the
+        # settings show them as they are, changes still queued behind a
+        # model request aren't applied yet
+        def decorate(func: Callable) -> Callable:
+            @functools.wraps(func)
+            async def wrapper(self: 'BotHandler',
+                              update: Update,
+                              context: CallbackContext,
+                              *args,
+                              **kwargs):
+                async def handle():
+                    chat_context = await self.get_chat_context(update, context)
+                    try:
+                        res = await func(self,
+                                         chat_context,
+                                         update,
+                                         context,
+                                         *args,
+                                         **kwargs)
+                    finally:
+                        self._store.mark_dirty(chat_context.chat_id)
+                        for task in chat_context.switcher.background_tasks():
+                            self._store.hold(chat_context.chat_id, task)
+                        self._store.release(chat_context.chat_id)
+                        self._store.schedule_flush()
+                    return res
+                if not ordered:
+                    chat_context = await self._store.acquire(context._chat_id)
+                    try:
+                        # a new chat is created in order with its other
+                        # updates
+                        if chat_context is not None:
+                            return await func(self,
+                                              chat_context,
+                                              update,
+                                              context,
+                                              *args,
+                                              **kwargs)
+                    finally:
+                        self._store.release(context._chat_id)
+                # updates of a chat are handled in order, one at a time
                 try:
-                    return pickle.load(f)
-                except (EOFError, pickle.UnpicklingError):
-                    return {}
-        return {}
-
-    def chat_context(func):
-        @functools.wraps(func)
-        async def wrapper(self: 'BotHandler',
-                          update: Update,
-                          context: CallbackContext,
-                          *args,
-                          **kwargs):
-            chat_context = self.get_chat_context(update, context)
-            res = await func(self,
-                             chat_context,
-                             update,
-                             context,
-                             *args,
-                             **kwargs)
-            self.dump_contexts(self._contexts_dump_path)
-            return res
-        return wrapper
+                    return await self._scheduler.run(context._chat_id,
+                                                     handle,
+                                                     heavy=heavy)
+                except ChatSchedulerOverloaded:
+                    await self._sender.send(context._chat_id, BUSY_MESSAGE)
+            return wrapper
+        if func is None:
+            return decorate
+        return decorate(func)
 
     async def _show_main_menu(self, chat_id: int) -> None:
-        await self._bot.send_message(chat_id,
-                                     self.main_menu.title,
-                                     parse_mode=ParseMode.HTML,
-                                     reply_markup=self.main_menu.markup)
+        await self._sender.send(chat_id,
+                                self.main_menu.title,
+                                parse_mode=ParseMode.HTML,
+                                reply_markup=self.main_menu.markup)
 
     async def _show_mode_menu(self, chat_id: int) -> None:
-        await self._bot.send_message(chat_id,
-                                     self.mode_menu.title,
-                                     parse_mode=ParseMode.HTML,
-                                     reply_markup=self.mode_menu.markup)
+        await self._sender.send(chat_id,
+                                self.mode_menu.title,
+                                parse_mode=ParseMode.HTML,
+                                reply_markup=self.mode_menu.markup)
 
     async def _show_model_menu(self, chat_id: int) -> None:
-        await self._bot.send_message(chat_id,
-                                     self.model_menu.title,
-                                     parse_mode=ParseMode.HTML,
-                                     reply_markup=self.model_menu.markup)
+        await self._sender.send(chat_id,
+                                self.model_menu.title,
+                                parse_mode=ParseMode.HTML,
+                                reply_markup=self.model_menu.markup)
 
-    @chat_context
+    @chat_context(ordered=False)
     async def show_main_menu_callback(self,
                                       chat_context: ChatContext,
                                       update: Update,
                                       context: CallbackContext):
         await self._show_main_menu(chat_context.chat_id)
 
-    @chat_context
+    @chat_context(ordered=False)
     async def show_mode_callback(self,
                                  chat_context: ChatContext,
                                  update: Update,
                                  context: CallbackContext) -> None:
-        await self._bot.send_message(
+        await self._sender.send(
             chat_context.chat_id,
             f'В данный момент ты в режиме {chat_context.switcher.mode}'
         )
 
+    async def _switch_mode(self, chat_context: ChatContext, mode: str) -> bool:
+        # users who aren't allowed only have the NOT_ALLOWED mode
+        try:
+            chat_context.switcher.mode = mode
+        except SwitcherException:
+            await self._sender.send(chat_context.chat_id, NOT_ALLOWED_MESSAGE)
+            return False
+        return True
+
     @chat_context
     async def handle_menu_callback(self,
                                    chat_context: ChatContext,
@@ -220,30 +414,53 @@ class BotHandler:
         elif data == 'MODEL':
             await self._show_model_menu(chat_context.chat_id)
         elif data == 'SQL':
-            chat_context.switcher.mode = data
-            await self._bot.send_message(chat_context.chat_id,
-                                         'Ты теперь используешь SQL режим. '
-                                         'Скажи мне, какой SQL запрос '
-                                         'сконструировать')
+            if not await self._switch_mode(chat_context, data):
+                return
+            await self._sender.send(chat_context.chat_id,
+                                    'Ты теперь используешь SQL режим. '
+                                    'Скажи мне, какой SQL запрос '
+                                    'сконструировать')
         elif data == 'FREE':
-            chat_context.switcher.mode = data
-            await self._bot.send_message(chat_context.chat_id,
-                                         'Ты теперь используешь FREE режим. '
-                                         'Спроси меня о чем угодно')
+            if not await self._switch_mode(chat_context, data):
+                return
+            await self._sender.send(chat_context.chat_id,
+                                    'Ты теперь используешь FREE режим. '
+                                    'Спроси меня о чем угодно')
+        elif data == 'COMPARE':
+            switcher = chat_context.switcher
+            if (data not in switcher.modes
+                    and chat_context.username in ALLOWED_USERS):
+                # switchers saved before the mode appeared get it on first use
+                switcher.add_mode(data, CompareBackend(SQL_CONTEXT.read_text()))
+            if not await self._switch_mode(chat_context, data):
+                return
+            await self._sender.send(
+                chat_context.chat_id,
+                'Ты теперь сравниваешь модели: SQL вопрос уйдет сразу в '
+                f'{", ".join(switcher.backend.models)}, ответы придут по мере '
+                'готовности'
+            )
         elif data == 'GPT3.5':
                 chat_context.switcher.model_name = 'gpt-3.5-turbo'
-                await self._bot.send_message(
+                await self._sender.send(
                     chat_context.chat_id,
                     'Ты теперь используешь версию '
                     f'{chat_context.switcher.model_name}'
                 )
         elif data == 'GPT4':
             chat_context.switcher.model_name = 'gpt-4'
-            await context.bot.send_message(
+            await self._sender.send(
                 chat_context.chat_id,
                 'Ты теперь используешь версию '
                 f'{chat_context.switcher.model_name}'
             )
+        elif data == 'AUTO':
+            chat_context.switcher.model_name = AUTO_MODEL
+            await self._sender.send(
+                chat_context.chat_id,
+                'Теперь модель выбирается автоматически: простые вопросы '
+                'получает самая быстрая модель, сложные - самая сильная'
+            )
         elif data == 'BACK':
             await self._show_main_menu(chat_context.chat_id)
         else:
@@ -260,7 +477,135 @@ class BotHandler:
             valid_mentions[match] = match in table_names
         return valid_mentions
 
-    @chat_context
+    @staticmethod
+    def _retrieve_tables(schema: Schema, data: str) -> List[str]:
+        start = time.perf_counter()
+        found = schema.retriever.search(data,
+                                        top_k=RETRIEVAL_TOP_K,
+                                        min_score=RETRIEVAL_MIN_SCORE)
+        logger.info('Retrieved tables %s out of %d in %.2f ms',
+                    [f'{table}:{score:.2f}' for table, score in found],
+                    schema.retriever.size,
+                    (time.perf_counter() - start) * 1000)
+        return [table for table, _ in found]
+
+    async def _stream_answer(self,
+                             chat_id: int,
+                             pieces: AsyncIterator[str],
+                             decoder: StreamDecoder) -> Tuple[str, str, bool]:
+        encoded = []
+        answer = ''
+        # start of the part of the answer shown in `message`
+        offset = 0
+        shown = ''
+        last_edit = 0.0
+
+        async def start_message() -> Optional[Message]:
+            # the message being edited is never merged with other ones.
+            # A failed send leaves the rest of the answer unshown until
+            # the stream ends, the model is still read to the end
+            try:
+                return await self._sender.send(chat_id,
+                                               STREAM_PLACEHOLDER,
+                                               coalesce=False)
+            except TelegramError as exc:
+                logger.warning('Failed to start a streamed message in chat '
+                               '%s: %r', chat_id, exc)
+                return None
+
+        async def show(text: str):
+            nonlocal shown, last_edit
+            text = text.strip()
+            if message is None or not text or text == shown:
+                return
+            try:
+                await self._sender.edit(message, text)
+            except TelegramError as exc:
+                # e.g. "message is not modified" or markup cut in half,
+                # the next edit shows more of the answer anyway
+                logger.warning('Failed to edit a streamed message in chat '
+                               '%s: %r', chat_id, exc)
+            else:
+                shown = text
+            last_edit = time.monotonic()
+
+        async def overflow():
+            # a full message is finished at a paragraph or line boundary
+            # and the rest goes into a new one
+            nonlocal message, offset, shown
+            while len(answer) - offset > MAX_MESSAGE_LENGTH:
+                cut = split_point(answer[offset:], MAX_MESSAGE_LENGTH)
+                await show(answer[offset:offset + cut])
+                offset += cut
+                message = await start_message()
+                shown = ''
+
+        message = await start_message()
+        ok = True
+        try:
+            async for piece in pieces:
+                encoded.append(piece)
+                answer += decoder.feed(piece)
+                await overflow()
+                if time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+                    await show(answer[offset:])
+        except ModelRequestError as exc:
+            # what was shown stays, the reason is added after it
+            ok = False
+            answer += decoder.flush()
+            answer = f'{answer}\n\n{exc}' if answer.strip() else str(exc)
+        finally:
+            # closes the model stream if the answer was left unfinished
+            await pieces.aclose()
+        answer += decoder.flush()
+        await overflow()
+        if message is None and answer[offset:].strip():
+            # the last message couldn't be started, the rest is sent as
+            # an ordinary one
+            try:
+                await self._sender.send(chat_id, answer[offset:])
+            except TelegramError as exc:
+                logger.warning('Failed to send a streamed answer to chat '
+                               '%s: %r', chat_id, exc)
+        else:
+            await show(answer[offset:])
+        return ''.join(encoded), answer, ok
+
+    async def _compare_answers(self,
+                               chat_context: ChatContext,
+                               backend: CompareBackend,
+                               message: str,
+                               encoder: SimpleEncoder,
+                               decoding_mapping: Dict[str, str]):
+        answers = []
+        async for compared in backend.compare(message):
+            answer = encoder.decode(compared.answer, decoding_mapping)
+            answers.append({'model': compared.model,
+                            'answer': answer,
+                            'latency': round(compared.latency, 2),
+                            'prompt_tokens': compared.prompt_tokens,
+                            'completion_tokens': compared.completion_tokens,
+                            'failed': compared.failed})
+            template = COMPARE_FAILURE if compared.failed else COMPARE_ANSWER
+            # every answer is a message of its own, not merged with the
+            # next one
+            await self._sender.send(
+                chat_context.chat_id,
+                template.format(**{**answers[-1],
+                                   'latency': compared.latency}),
+                coalesce=False
+            )
+        # one record for the whole comparison
+        self._save_ask_to_history(
+            context=chat_context,
+            ask=encoder.decode(message, decoding_mapping),
+            answer='\n\n'.join(f'[{item["model"]}]\n{item["answer"]}'
+                                for item in answers),
+            model=','.join(backend.models),
+            answers=answers
+        )
+
+    @chat_context(heavy=True)
     async def handle_message_callback(self,
                                       chat_context: ChatContext,
                                       update: Update,
@@ -269,73 +614,134 @@ class BotHandler:
         if not input_message:
             return
         # TODO: Refactor. Too big function. Distinguish SQL and FREE modes
-        mentions = self._find_table_mentions(self._description_parser,
+        schema = self._description_watcher.schema
+        response_cache.set_schema_version(schema.description_parser.digest)
+        self._semantic_cache.set_schema_version(
+            schema.description_parser.digest
+        )
+        mentions = self._find_table_mentions(schema.description_parser,
                                              input_message)
         input_message = input_message.replace('$', '')
         if not all(mentions.values()):
             not_found_tables = [k for k, v in mentions.items() if not v]
             msg = f'Tables {not_found_tables} were not found.'
-            await context.bot.send_message(chat_context.chat_id,
-                                           msg,
-                                           entities=update.message.entities)
+            await self._sender.send(chat_context.chat_id, msg)
             return
+        tables = list(mentions)
+        if not tables and isinstance(chat_context.switcher.backend, SQLBackend):
+            tables = self._retrieve_tables(schema, input_message)
 
         encoded_additional_context = []
         decoding_mapping = {}
-        for table in mentions:
-            encoded_table, table_decoding_mapping = self._encoder.encode(
-                self._description_parser.get_table_description(table)
-            )
-            encoded_additional_context.append(encoded_table)
-            decoding_mapping.update(table_decoding_mapping)
-        encoded_msg, msg_decoding_mapping = self._encoder.encode(input_message)
+        tokens_saved = 0
+        for table in tables:
+            encoded_table = schema.encoder.encode_table(table)
+            pruned = self._column_pruner.prune(encoded_table, input_message)
+            tokens_saved += pruned.tokens_saved
+            if pruned.kept < pruned.total:
+                logger.info('Pruned %s to %d of %d columns, %d -> %d tokens',
+                            table, pruned.kept, pruned.total,
+                            pruned.tokens_full, pruned.tokens_kept)
+            encoded_additional_context.append(pruned.text)
+            decoding_mapping.update(encoded_table.decoding_mapping)
+        if tokens_saved:
+            logger.info('Column pruning saved %d tokens for %s',
+                        tokens_saved, chat_context.username)
+        encoded_msg, msg_decoding_mapping = schema.encoder.encode(input_message)
         decoding_mapping.update(msg_decoding_mapping)
-        encoded_message_full = (f'{encoded_msg}\n'
-                                '\n'.join(encoded_additional_context))
-        await context.bot.send_message(chat_context.chat_id,
-                                       encoded_message_full,
-                                       entities=update.message.entities)
-        answer = await chat_context.switcher.backend.handle(encoded_message_full)
-        decoded_answer = self._encoder.decode(answer, decoding_mapping)
-        await self._save_ask_to_history(
+        encoded_message_full = '\n'.join([encoded_msg,
+                                          *encoded_additional_context])
+        await self._sender.send(chat_context.chat_id, encoded_message_full)
+        backend = chat_context.switcher.backend
+        # SQL answers don't depend on the chat history, so a question
+        # asked about the same tables with other wording can reuse one
+        semantic_scope = None
+        if (isinstance(backend, SQLBackend)
+                and not isinstance(backend, CompareBackend)
+                and self._semantic_cache.cacheable(backend.temperature)):
+            semantic_scope = scope_key(backend.model_name,
+                                       backend.sql_prompt,
+                                       *sorted(tables))
+        cached = None
+        if semantic_scope is not None:
+            cached = self._semantic_cache.lookup(encoded_msg, semantic_scope)
+        if cached is None and isinstance(backend, ChatGPTBackend):
+            try:
+                usage_meter.check(chat_context.username)
+            except UsageQuotaExceeded as exc:
+                logger.info('%s', exc)
+                await self._sender.send(
+                    chat_context.chat_id,
+                    QUOTA_MESSAGE.format(used=exc.used, quota=exc.quota)
+                )
+                return
+        streamed = False
+        failed = False
+        # the "auto" model is chosen by the question and the number of
+        # tables, not by the whole prompt with their descriptions
+        hint = routing_hint.set(RoutingHint(encoded_msg, len(tables)))
+        # tokens are metered per user and mode, summaries folded in the
+        # background are counted to the user as well
+        scope = usage_scope.set(UsageScope(chat_context.username,
+                                           chat_context.switcher.mode))
+        try:
+            if cached is not None:
+                answer, similarity = cached
+                logger.info('Semantic cache hit for %s, similarity %.3f',
+                            chat_context.username, similarity)
+            elif isinstance(backend, CompareBackend):
+                await self._compare_answers(chat_context,
+                                            backend,
+                                            encoded_message_full,
+                                            schema.encoder,
+                                            decoding_mapping)
+                return
+            elif getattr(backend, 'stream', False):
+                answer, decoded_answer, ok = await self._stream_answer(
+                    chat_context.chat_id,
+                    backend.handle_stream(encoded_message_full),
+                    StreamDecoder(decoding_mapping)
+                )
+                streamed = True
+                failed = not ok
+            else:
+                answer = await backend.handle(encoded_message_full)
+        except ModelRequestError as exc:
+            answer = str(exc)
+            failed = True
+        finally:
+            usage_scope.reset(scope)
+            routing_hint.reset(hint)
+        # only real answers are reused, a failure would be replayed to
+        # every similar question
+        if (semantic_scope is not None and cached is None
+                and not failed and answer):
+            self._semantic_cache.add(encoded_msg, semantic_scope, answer)
+        if not streamed:
+            decoded_answer = schema.encoder.decode(answer, decoding_mapping)
+        self._save_ask_to_history(
             context=chat_context,
-            ask=self._encoder.decode(encoded_message_full, decoding_mapping),
+            ask=schema.encoder.decode(encoded_message_full, decoding_mapping),
             answer=decoded_answer
         )
-        for i in range(len(decoded_answer) // MAX_MESSAGE_LENGTH):
-            print(len(decoded_answer[i * MAX_MESSAGE_LENGTH:(i + 1) * MAX_MESSAGE_LENGTH + 1]))
-            await context.bot.send_message(
-                chat_context.chat_id,
-                decoded_answer[i * MAX_MESSAGE_LENGTH:(i + 1) * MAX_MESSAGE_LENGTH + 1],
-                entities=update.message.entities
-            )
-        left = len(decoded_answer) % MAX_MESSAGE_LENGTH
-        if left:
-            await context.bot.send_message(chat_context.chat_id,
-                                           decoded_answer[-left:],
-                                           entities=update.message.entities)
-        # await context.bot.send_message(chat_context.chat_id,
-        #                                answer,
-        #                                entities=update.message.entities)
-        # await context.bot.send_message(chat_context.chat_id,
-        #                                decoded_answer,
-        #                                entities=update.message.entities)
+        if not streamed:
+            await self._sender.send(chat_context.chat_id, decoded_answer)
 
-    @chat_context
+    @chat_context(ordered=False)
     async def show_welcome_callback(self,
                                     chat_context: ChatContext,
                                     update: Update,
                                     context: CallbackContext) -> None:
-        await self._bot.send_message(chat_context.chat_id, START_MESSAGE)
+        await self._sender.send(chat_context.chat_id, START_MESSAGE)
 
-    @chat_context
+    @chat_context(ordered=False)
     async def show_help_callback(self,
                                  chat_context: ChatContext,
                                  update: Update,
                                  context: CallbackContext) -> None:
-        await self._bot.send_message(chat_context.chat_id, AVAILABLE_COMMANDS)
+        await self._sender.send(chat_context.chat_id, AVAILABLE_COMMANDS)
     
-    @chat_context
+    @chat_context(ordered=False)
     async def show_parameters_callback(self,
                                        chat_context: ChatContext,
                                        update: Update,
@@ -345,14 +751,23 @@ class BotHandler:
             sql_prompt = backend.sql_prompt
         else:
             sql_prompt = None
-        await self._bot.send_message(
+        if isinstance(backend, FREEBackend):
+            summary = 'on' if backend.summarize else 'off'
+        else:
+            summary = None
+        await self._sender.send(
             chat_context.chat_id,
             f'model_name: {backend.model_name}\n'
             f'/model_name <value>\n\n'
-            f'context_depth: {backend.context_depth}\n'
-            '/context_depth <value> (от 1 до 30)\n\n'
+            f'context_tokens: {backend.context_tokens}\n'
+            '/context_tokens <value> (от 0, токены прошлых реплик)\n\n'
             f'sql_prompt: {sql_prompt}\n'
             '/sql_prompt <value> (строка с контекстом для sql режима)\n\n'
+            f'summary: {summary}\n'
+            '/summary <on|off> (сжимать старые реплики free режима '
+            'в краткое содержание)\n\n'
+            f'stream: {"on" if getattr(backend, "stream", False) else "off"}\n'
+            '/stream <on|off> (показывать ответ по мере генерации)\n\n'
             f'max_tokens: {backend.max_tokens}\n'
             '/max_tokens <value> (от 0)\n\n'
             f'temperature: {backend.temperature}\n'
@@ -384,33 +799,48 @@ class BotHandler:
                 chat_context.switcher.backend.context
             )
         )
-        await self._bot.send_message(chat_context.chat_id, msg)
+        await self._sender.send(chat_context.chat_id, msg)
     
     @chat_context
-    async def set_context_depth_callback(self,
-                                         chat_context: ChatContext,
-                                         update: Update,
-                                         context: CallbackContext) -> None:
-        chat_context.switcher.backend.context_depth = int(context.args[0])
-    
+    async def set_context_tokens_callback(self,
+                                          chat_context: ChatContext,
+                                          update: Update,
+                                          context: CallbackContext) -> None:
+        chat_context.switcher.backend.context_tokens = int(context.args[0])
+
+    @chat_context
+    async def set_stream_callback(self,
+                                  chat_context: ChatContext,
+                                  update: Update,
+                                  context: CallbackContext) -> None:
+        if not isinstance(chat_context.switcher.backend, ChatGPTBackend):
+            await self._sender.send(chat_context.chat_id,
+                                    'В этом режиме ответы не генерируются')
+            return
+        chat_context.switcher.backend.stream = context.args[0] == 'on'
+
     @chat_context
     async def set_sql_prompt_callback(self,
                                       chat_context: ChatContext,
                                       update: Update,
                                       context: CallbackContext) -> None:
         if not isinstance(chat_context.switcher.backend, SQLBackend):
-            await self._bot.send_message(chat_context.chat_id,
-                                         'Сначала нужно перейти в режим SQL')
+            await self._sender.send(chat_context.chat_id,
+                                    'Сначала нужно перейти в режим SQL')
             return
         chat_context.switcher.backend.sql_prompt = ' '.join(context.args)
 
     @chat_context
-    async def set_context_depth_callback(self,
-                                         chat_context: ChatContext,
-                                         update: Update,
-                                         context: CallbackContext) -> None:
-        chat_context.switcher.backend.context_depth = int(context.args[0])
-    
+    async def set_summary_callback(self,
+                                   chat_context: ChatContext,
+                                   update: Update,
+                                   context: CallbackContext) -> None:
+        if not isinstance(chat_context.switcher.backend, FREEBackend):
+            await self._sender.send(chat_context.chat_id,
+                                    'Сначала нужно перейти в режим FREE')
+            return
+        chat_context.switcher.backend.summarize = context.args[0] == 'on'
+
     @chat_context
     async def set_max_tokens_callback(self,
                                       chat_context: ChatContext,
@@ -453,13 +883,118 @@ class BotHandler:
                                 context: CallbackContext) -> None:
         chat_context.switcher.backend.role = context.args[0]
     
-    @chat_context
+    @chat_context(ordered=False)
+    async def show_stats_callback(self,
+                                  chat_context: ChatContext,
+                                  update: Update,
+                                  context: CallbackContext) -> None:
+        sections = {
+            'Кэш контекстов': self._store.stats,
+            'Кэш ответов': response_cache.stats,
+            'Семантический кэш': self._semantic_cache.stats,
+            'Одинаковые запросы': in_flight.stats,
+            'Запросы к модели': request_policy.stats,
+            'Задержка модели': latency.stats,
+            'Ключи OpenAI': key_pool.stats,
+            'Выбор модели': model_router.stats,
+            'Расход токенов': usage_meter.stats,
+            'Отправка сообщений': self._sender.stats,
+            'Очередь обработки': self._scheduler.stats,
+            'Очередь этого чата': self._scheduler.chat_stats(
+                chat_context.chat_id
+            )
+        }
+        await self._sender.send(
+            chat_context.chat_id,
+            '\n\n'.join(
+                f'{title}:\n' + '\n'.join(f'{k}: {v}' for k, v in stats.items())
+                for title, stats in sections.items()
+            )
+        )
+
+    @chat_context(ordered=False)
+    async def show_usage_callback(self,
+                                  chat_context: ChatContext,
+                                  update: Update,
+                                  context: CallbackContext) -> None:
+        days = 1
+        username = chat_context.username
+        for arg in context.args:
+            period = USAGE_PERIOD_PATTERN.match(arg.lower())
+            if period:
+                days = max(int(period[1]), 1)
+            elif arg.lower() == 'all' and username in ADMIN_USERS:
+                username = None
+            else:
+                await self._sender.send(chat_context.chat_id,
+                                        f'Неизвестный аргумент - {arg}')
+                return
+        since = datetime.date.today() - datetime.timedelta(days=days - 1)
+        rows = await usage_meter.report(since.isoformat(), username)
+        quota = usage_meter.quota(chat_context.username)
+        lines = [
+            f'Использовано сегодня: '
+            f'{usage_meter.spent_today(chat_context.username)}'
+            f' из {quota if quota is not None else "∞"} токенов',
+            f'За {days} дн. (запросы, токены запроса + ответа, '
+            f'средняя задержка):'
+        ]
+        for row in rows:
+            counters = row.counters
+            prefix = f'{row.username} ' if username is None else ''
+            lines.append(
+                f'{prefix}{row.model} / {row.mode}: {counters.requests}, '
+                f'{counters.prompt_tokens} + {counters.completion_tokens}, '
+                f'{counters.latency / counters.requests:.1f} с'
+            )
+        if not rows:
+            lines.append('Запросов не было')
+        await self._sender.send(chat_context.chat_id, '\n'.join(lines))
+
+    @chat_context(ordered=False)
+    async def reload_descriptions_callback(self,
+                                           chat_context: ChatContext,
+                                           update: Update,
+                                           context: CallbackContext) -> None:
+        if chat_context.username not in ADMIN_USERS:
+            await self._sender.send(chat_context.chat_id,
+                                    'Команда доступна только администраторам')
+            return
+        try:
+            changes = await self._description_watcher.reload()
+        except Exception as exc:
+            logger.exception('Failed to reload table descriptions')
+            await self._sender.send(chat_context.chat_id,
+                                    f'Не удалось перечитать описания: {exc}')
+            return
+        await self._sender.send(chat_context.chat_id, str(changes))
+
+    @chat_context(ordered=False)
     async def get_history(self,
                           chat_context: ChatContext,
                           update: Update,
                           context: CallbackContext):
-        with open(self._history_file_name, 'r') as f:
-            await self._bot.send_document(chat_context.chat_id, f)
+        try:
+            history_filter = parse_history_filter(
+                context.args,
+                username=chat_context.username,
+                modes=chat_context.switcher.modes
+            )
+        except HistoryFilterError as exc:
+            await self._sender.send(chat_context.chat_id, str(exc))
+            return
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = Path(tmp_dir) / 'history.jsonl.gz'
+            exported = await asyncio.to_thread(export_history,
+                                               self._history_file_name,
+                                               history_filter,
+                                               str(output))
+            if not exported:
+                await self._sender.send(chat_context.chat_id,
+                                        'Подходящих записей не найдено')
+                return
+            with open(output, 'rb') as f:
+                await self._bot.send_document(chat_context.chat_id, f)
 
 
 class IdleBackend(AbstractBackend):
@@ -471,7 +1006,7 @@ class IdleBackend(AbstractBackend):
 class NotAllowedBackend(AbstractBackend):
 
     async def handle(self, message: str) -> str:
-        return 'You are not allowed to use this bot'
+        return NOT_ALLOWED_MESSAGE
 
 
 def create_default_switcher(username):
@@ -484,6 +1019,7 @@ def create_default_switcher(username):
     modes = {
         'SQL': SQLBackend(sql_context),
         'FREE': FREEBackend(),
+        'COMPARE': CompareBackend(sql_context),
         'IDLE': IdleBackend()
     }
     return BackendSwitcher(modes=modes,
@@ -491,17 +1027,42 @@ def create_default_switcher(username):
                            default_model=default_model)
 
 
+async def on_startup(application: Application):
+    await session_pool.start()
+    await response_cache.open()
+    await usage_meter.open()
+    await application.bot_data['bot_handler'].start()
+
+
+async def on_shutdown(application: Application):
+    await application.bot_data['bot_handler'].close()
+    await session_pool.close()
+    response_cache.close()
+    await usage_meter.close()
+
+
 def main():
-    application = Application.builder().token(BOT_TOKEN).build()
-    description_parser = DescriptionParser(TABLE_DESCRIPTIONS)
-    encoder = SimpleEncoder(description_parser)
+    application = (Application.builder()
+                              .token(BOT_TOKEN)
+                              .post_init(on_startup)
+                              .post_shutdown(on_shutdown)
+                              .concurrent_updates(UPDATES_MAX_PENDING)
+                              .build())
+    description_parser = DescriptionParser(TABLE_DESCRIPTIONS,
+                                           snapshot_path=SCHEMA_SNAPSHOT)
+    description_watcher = DescriptionWatcher(
+        Schema.build(description_parser,
+                     index_path=RETRIEVAL_INDEX,
+                     encoder_cache_size=ENCODED_TABLES_CACHE_SIZE),
+        interval=DESCRIPTIONS_POLL_INTERVAL
+    )
     bot_handler = BotHandler(bot=application.bot,
                              main_menu=MAIN_MENU,
                              mode_menu=MODE_MENU,
                              model_menu=MODEL_MENU,
                              switcher_factory=create_default_switcher,
-                             encoder=encoder,
-                             description_parser=description_parser)
+                             description_watcher=description_watcher)
+    application.bot_data['bot_handler'] = bot_handler
     application.add_handler(
         CommandHandler('start', bot_handler.show_welcome_callback)
     )
@@ -524,11 +1085,18 @@ def main():
         CommandHandler('context', bot_handler.show_context_callback)
     )
     application.add_handler(
-        CommandHandler('context_depth', bot_handler.set_context_depth_callback)
+        CommandHandler('context_tokens',
+                       bot_handler.set_context_tokens_callback)
     )
     application.add_handler(
         CommandHandler('sql_prompt', bot_handler.set_sql_prompt_callback)
     )
+    application.add_handler(
+        CommandHandler('summary', bot_handler.set_summary_callback)
+    )
+    application.add_handler(
+        CommandHandler('stream', bot_handler.set_stream_callback)
+    )
     application.add_handler(
         CommandHandler('max_tokens', bot_handler.set_max_tokens_callback)
     )
@@ -552,6 +1120,16 @@ def main():
     application.add_handler(
         CommandHandler('history', bot_handler.get_history)
     )
+    application.add_handler(
+        CommandHandler('stats', bot_handler.show_stats_callback)
+    )
+    application.add_handler(
+        CommandHandler('usage', bot_handler.show_usage_callback)
+    )
+    application.add_handler(
+        CommandHandler('reload_descriptions',
+                       bot_handler.reload_descriptions_callback)
+    )
     application.add_handler(
         CallbackQueryHandler(bot_handler.handle_menu_callback)
     )
@@ -0,0 +1,31 @@
+import math
+from typing import Optional
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+DEFAULT_ENCODING = 'cl100k_base'
+# without tiktoken fall back to an estimate, cyrillic text averages
+# about three characters per token with OpenAI encodings
+CHARS_PER_TOKEN = 3
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    if tiktoken is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(_get_encoding(model).encode(text, disallowed_special=()))
+
+
+_encodings = {}
+
+
+def _get_encoding(model: Optional[str]):
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except (KeyError, TypeError):
+            _encodings[model] = tiktoken.get_encoding(DEFAULT_ENCODING)
+    return _encodings[model]
@@ -0,0 +1,238 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from dataclasses import dataclass
+import datetime
+import logging
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class UsageScope:
+    username: str
+    mode: str
+
+
+# set by the bot around a request, requests made outside of one (warming
+# up connections) are counted as nobody's
+usage_scope: ContextVar[Optional[UsageScope]] = ContextVar('usage_scope',
+                                                           default=None)
+_NO_SCOPE = UsageScope('-', '-')
+
+
+class UsageQuotaExceeded(Exception):
+
+    def __init__(self, username: str, used: int, quota: int):
+        super().__init__(f'{username} used {used} of {quota} tokens today')
+        self.used = used
+        self.quota = quota
+
+
+@dataclass
+class UsageCounters:
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    latency: float = 0.0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, other: 'UsageCounters'):
+        self.requests += other.requests
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.latency += other.latency
+
+
+@dataclass
+class UsageRow:
+    username: str
+    model: str
+    mode: str
+    counters: UsageCounters
+
+
+def _today() -> str:
+    return datetime.date.today().isoformat()
+
+
+class UsageMeter:
+    # tokens and latency of every completion are summed in memory per day,
+    # user, model and mode and written to sqlite every few seconds. Tokens
+    # a user spent today are kept in memory to check the daily quota
+    # before a request is sent
+
+    def __init__(self,
+                 db_path: str,
+                 daily_quota: Optional[int],
+                 user_quotas: Optional[Dict[str, Optional[int]]] = None):
+        self._daily_quota = daily_quota
+        self._user_quotas = dict(user_quotas or {})
+        # (day, username, model, mode) -> counters not written yet
+        self._pending: Dict[Tuple[str, str, str, str], UsageCounters] = {}
+        self._day = _today()
+        self._spent_today: Dict[str, int] = {}
+        self._total = UsageCounters()
+        self._rejected = 0
+        self._db_path = db_path
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'requests': self._total.requests,
+            'prompt_tokens': self._total.prompt_tokens,
+            'completion_tokens': self._total.completion_tokens,
+            'rejected': self._rejected,
+            'pending': len(self._pending)
+        }
+
+    def quota(self, username: str) -> Optional[int]:
+        return self._user_quotas.get(username, self._daily_quota)
+
+    def spent_today(self, username: str) -> int:
+        self._roll_over()
+        return self._spent_today.get(username, 0)
+
+    def _roll_over(self):
+        today = _today()
+        if today != self._day:
+            self._day = today
+            self._spent_today.clear()
+
+    def check(self, username: str):
+        quota = self.quota(username)
+        if quota is None:
+            return
+        used = self.spent_today(username)
+        if used >= quota:
+            self._rejected += 1
+            raise UsageQuotaExceeded(username, used, quota)
+
+    def record(self,
+               model: str,
+               prompt_tokens: int,
+               completion_tokens: int,
+               latency: float):
+        scope = usage_scope.get() or _NO_SCOPE
+        self._roll_over()
+        counters = UsageCounters(1, prompt_tokens, completion_tokens, latency)
+        key = (self._day, scope.username, model, scope.mode)
+        self._pending.setdefault(key, UsageCounters()).add(counters)
+        self._total.add(counters)
+        self._spent_today[scope.username] = (
+            self._spent_today.get(scope.username, 0) + counters.total_tokens
+        )
+
+    async def open(self):
+        if self._executor is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='usage')
+        await self._in_thread(self._open, str(self._db_path))
+
+    async def flush(self):
+        # counters recorded before the database is opened wait for it
+        if self._executor is None or not self._pending:
+            return
+        rows, self._pending = self._pending, {}
+        try:
+            await self._in_thread(self._write, rows)
+        except Exception:
+            # put back to be written with the next batch
+            for key, counters in rows.items():
+                self._pending.setdefault(key, UsageCounters()).add(counters)
+            raise
+
+    async def flush_forever(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Failed to write usage, %d rows pending',
+                                 len(self._pending))
+
+    async def report(self,
+                     since: str,
+                     username: Optional[str] = None) -> List[UsageRow]:
+        # counters still in memory are written first, so the report is
+        # read from one place
+        await self.flush()
+        if self._executor is None:
+            return []
+        return await self._in_thread(self._read, since, username)
+
+    async def _in_thread(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _open(self, path: str):
+        self._connection = sqlite3.connect(path)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS usage ('
+            'day TEXT NOT NULL, '
+            'username TEXT NOT NULL, '
+            'model TEXT NOT NULL, '
+            'mode TEXT NOT NULL, '
+            'requests INTEGER NOT NULL, '
+            'prompt_tokens INTEGER NOT NULL, '
+            'completion_tokens INTEGER NOT NULL, '
+            'latency REAL NOT NULL, '
+            'PRIMARY KEY (day, username, model, mode))'
+        )
+        self._connection.commit()
+        # quotas keep counting after a restart
+        for username, tokens in self._connection.execute(
+            'SELECT username, SUM(prompt_tokens + completion_tokens) '
+            'FROM usage WHERE day = ? GROUP BY username',
+            (self._day,)
+        ):
+            self._spent_today[username] = (self._spent_today.get(username, 0)
+                                           + tokens)
+
+    def _write(self, rows: Dict[Tuple[str, str, str, str], UsageCounters]):
+        with self._connection:
+            self._connection.executemany(
+                'INSERT INTO usage (day, username, model, mode, requests, '
+                'prompt_tokens, completion_tokens, latency) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (day, username, model, mode) DO UPDATE SET '
+                'requests = requests + excluded.requests, '
+                'prompt_tokens = prompt_tokens + excluded.prompt_tokens, '
+                'completion_tokens = '
+                'completion_tokens + excluded.completion_tokens, '
+                'latency = latency + excluded.latency',
+                [(*key, counters.requests, counters.prompt_tokens,
+                  counters.completion_tokens, counters.latency)
+                 for key, counters in rows.items()]
+            )
+
+    def _read(self, since: str, username: Optional[str]) -> List[UsageRow]:
+        query = ('SELECT username, model, mode, SUM(requests), '
+                 'SUM(prompt_tokens), SUM(completion_tokens), SUM(latency) '
+                 'FROM usage WHERE day >= ?')
+        args = [since]
+        if username is not None:
+            query += ' AND username = ?'
+            args.append(username)
+        query += (' GROUP BY username, model, mode '
+                  'ORDER BY SUM(prompt_tokens + completion_tokens) DESC')
+        return [UsageRow(user, model, mode, UsageCounters(*counters))
+                for user, model, mode, *counters
+                in self._connection.execute(query, args)]
+
+    async def close(self):
+        if self._executor is None:
+            return
+        await self.flush()
+        await self._in_thread(self._connection.close)
+        self._executor.shutdown(wait=True)